@@ -3,7 +3,17 @@ import sys
 import os
 import re
 import logging
-from itertools import islice
+import gzip
+import zlib
+import struct
+import io
+import mmap
+import shutil
+import fcntl
+import hashlib
+from array import array
+from bisect import bisect_left, bisect_right
+import numpy as np
 import pysam
 
 #################
@@ -12,21 +22,31 @@ import pysam
 
 class DNASequence(object):
     """
-    An object to hold a DNA sequence with some methods to manipulate it
+    An object to hold a DNA sequence with some methods to manipulate it.
+    The sequence is kept as bytes (or the bytearray it was built in), all
+    per base work is done by bytes.translate at C speed
     """
     
-    alphabet = set('ACTGNactgn')
-    complement = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A', 'N': 'N',\
-                  'a': 't','c' : 'g', 'g': 'c','t': 'a','n':'n'}
+    __slots__ = ('identifier', 'sequence')
+    
+    alphabet = b'ACTGNactgn'
+    complement = bytes.maketrans(b'ACGTNacgtn', b'TGCANtgcan')
     
     def __init__(self, identifier, sequence):
         self.identifier = identifier
+        if isinstance(sequence, str):
+            try:
+                sequence = sequence.encode('ascii')
+            except UnicodeEncodeError as e:
+                raise IncorrectSequenceLetter(e.object[e.start],\
+                                              self.__class__.__name__)
         self.sequence = sequence
         
-        for letter in self.sequence:
-            if letter not in self.alphabet:
-                raise IncorrectSequenceLetter(letter,\
-                                              self.__class__.__name__)
+        #deleting all valid letters leaves the invalid ones
+        invalid = self.sequence.translate(None, self.alphabet)
+        if invalid:
+            raise IncorrectSequenceLetter(chr(invalid[0]),\
+                                          self.__class__.__name__)
     def __len__(self):
         return len(self.sequence)
     
@@ -42,16 +62,23 @@ class DNASequence(object):
         """
         return a nicely formated fasta string
         """
-        splitted_seq = []
-        for x in range(0,len(self.sequence),80):
-            splitted_seq.append(self.sequence[x:x+80])
-        return ">%s\n%s\n" %(self.identifier,"\n".join(splitted_seq))
+        out = io.BytesIO()
+        self.write_fasta(out)
+        return out.getvalue().decode()
+    
+    def write_fasta(self, out, lineLength=80):
+        """
+        write the sequence in fasta format to a binary file object, wrapped
+        in lines of lineLength, without building the whole record in memory
+        """
+        out.write('>{}\n'.format(self.identifier).encode())
+        write_wrapped(out, [self.sequence], lineLength)
     
     def get_revcomplement(self):
         """
         return a DNASequence instance of the complement of the current sequence
         """
-        complementSeq = "".join([ self.complement[letter] for letter in self.sequence ])
+        complementSeq = self.sequence.translate(self.complement)
         return DNASequence(identifier = self.identifier+"_complement",\
                            sequence = complementSeq[::-1] )
 
@@ -119,58 +146,1009 @@ class ParseFastQ(object):
          
         # ++++ Return fatsQ data as tuple ++++
         return tuple(elemList)
+
+class FastqBlock(object):
+    """
+    A block of complete fastq records parsed in one go from a bytes buffer.
+    Records are handed out as memoryviews into the buffer, so nothing is
+    copied unless asked for
+    """
+    
+    __slots__ = ('buffer', 'lineStarts')
+    
+    def __init__(self, buffer, lineStarts):
+        #lineStarts is an int64 array of the offsets of all lines plus the
+        #end of the block
+        self.buffer = buffer
+        self.lineStarts = lineStarts
+    
+    def __len__(self):
+        return (len(self.lineStarts)-1)//4
+    
+    def __iter__(self):
+        """
+        yield the records as tuples of four memoryviews without newlines
+        """
+        view = memoryview(self.buffer)
+        s = self.lineStarts
+        #the views are sliced lazily and grouped by four, all in C
+        lines = map(view.__getitem__, map(slice, s[:-1].tolist(), \
+                                          (s[1:]-1).tolist()))
+        return zip(lines, lines, lines, lines)
+    
+    def record(self, i):
+        """
+        return the four lines of record i as memoryviews without newlines
+        """
+        view = memoryview(self.buffer)
+        s = self.lineStarts[4*i:4*i+5].tolist()
+        return tuple(view[s[j]:s[j+1]-1] for j in range(4))
+    
+    def raw(self, start=0, stop=None):
+        """
+        return the records [start, stop) including newlines as one memoryview
+        """
+        if stop is None:
+            stop = len(self)
+        return memoryview(self.buffer)[self.lineStarts[4*start]:\
+                                       self.lineStarts[4*stop]]
+    
+    def sequences(self, start=0, stop=None):
+        """
+        return the sequences of the records [start, stop) as bytes
+        """
+        if stop is None:
+            stop = len(self)
+        buffer = self.buffer
+        s = self.lineStarts
+        return list(map(buffer.__getitem__, \
+                        map(slice, s[4*start+1:4*stop:4].tolist(), \
+                            (s[4*start+2:4*stop+1:4]-1).tolist())))
+    
+    def lengths(self, start=0, stop=None):
+        """
+        return the sequence lengths of the records [start, stop)
+        """
+        if stop is None:
+            stop = len(self)
+        s = self.lineStarts
+        return (s[4*start+2:4*stop+1:4]-s[4*start+1:4*stop:4]-1).tolist()
     
+    def bases(self, start=0, stop=None):
+        """
+        return the number of bases in the records [start, stop)
+        """
+        if stop is None:
+            stop = len(self)
+        s = self.lineStarts
+        return int(s[4*start+2:4*stop+1:4].sum()-s[4*start+1:4*stop:4].sum())-\
+               (stop-start)
+    
+    def names(self, start=0, stop=None):
+        """
+        return the read names of the records [start, stop) without
+        comments and /1 or /2 mate suffixes
+        """
+        if stop is None:
+            stop = len(self)
+        buffer = self.buffer
+        s = self.lineStarts
+        names = [name.split(None, 1)[0] for name in \
+                 map(buffer.__getitem__, \
+                     map(slice, (s[4*start:4*stop:4]+1).tolist(), \
+                         (s[4*start+1:4*stop+1:4]-1).tolist()))]
+        return [name[:-2] if name.endswith((b'/1', b'/2')) else name \
+                for name in names]
+    
+
+class PieceTable(object):
+    """
+    The edits of a scaffold, kept as pieces of the original sequence and
+    inserted bytes instead of a modified copy. Edits are applied with a
+    cursor, just like building the modified sequence by concatenation:
+    replace() takes over the original from the cursor up to the start of
+    the edit, inserts the new bytes and moves the cursor behind the
+    replaced bases. An edit starting before the cursor takes over nothing,
+    and one ending before it moves the cursor back
+    """
+    
+    __slots__ = ('original', 'pieces', 'length', 'cursor')
+    
+    def __init__(self, original):
+        self.original = memoryview(original)
+        #pieces are (start, end) tuples into the original or inserted bytes
+        self.pieces = []
+        self.length = 0
+        self.cursor = 0
+    
+    def __len__(self):
+        """
+        length of the modified sequence including the rest of the original
+        """
+        return self.length+max(0, len(self.original)-self.cursor)
+    
+    def replace(self, start, end, inserted):
+        """
+        replace the original bases [start, end) with the inserted bytes and
+        return where the inserted bytes start in the modified sequence
+        """
+        invalid = inserted.translate(None, DNASequence.alphabet)
+        if invalid:
+            raise IncorrectSequenceLetter(chr(invalid[0]), \
+                                          self.__class__.__name__)
+        if start > self.cursor:
+            self.pieces.append((self.cursor, start))
+            self.length += start-self.cursor
+        newStart = self.length
+        if inserted:
+            self.pieces.append(inserted)
+            self.length += len(inserted)
+        self.cursor = end
+        return newStart
+    
+    def chunks(self):
+        """
+        yield the modified sequence as views of the original and the
+        inserted bytes
+        """
+        for piece in self.pieces:
+            if isinstance(piece, tuple):
+                yield self.original[piece[0]:piece[1]]
+            else:
+                yield piece
+        if self.cursor < len(self.original):
+            yield self.original[self.cursor:]
+
+
+class FastaWriter(object):
+    """
+    Binary fasta writer that indexes what it writes. Offsets, lengths and
+    MD5 sums of the scaffolds are collected on the way, and on close() the
+    .fai index and the sequence dictionary (as samtools faidx and picard
+    CreateSequenceDictionary would write them) are put next to the fasta
+    """
+    
+    def __init__(self, path, lineLength=80):
+        self.path = path
+        self.lineLength = lineLength
+        self.out = open(path, 'wb')
+        self.offset = 0
+        #name, length, offset, line bases, line width and md5 per scaffold
+        self.index = []
+    
+    def write(self, data):
+        self.out.write(data)
+        self.offset += len(data)
+    
+    def write_record(self, identifier, chunks):
+        """
+        write a scaffold given as chunks of bytes, wrapped in lines
+        """
+        self.write('>{}\n'.format(identifier).encode())
+        start = self.offset
+        md5 = hashlib.md5()
+        write_wrapped(self, hash_chunks(chunks, md5), self.lineLength)
+        #all lines but the last one hold lineLength bases and a line break,
+        #an empty scaffold gets a single empty line
+        written = self.offset-start
+        length = written-(-(-written//(self.lineLength+1)))
+        self.index.append((identifier.split(None, 1)[0], length, start, \
+                           self.lineLength, self.lineLength+1, \
+                           md5.hexdigest()))
+    
+    def write_raw(self, fasta, identifier):
+        """
+        copy a scaffold of an IndexedFasta unchanged
+        """
+        length, offset, lineBases, lineWidth = fasta.index[identifier]
+        start = self.offset+fasta.write_raw(identifier, self)
+        self.index.append((identifier, length, start, lineBases, lineWidth, \
+                           hash_scaffold(fasta, identifier)))
+    
+    def close(self):
+        self.out.close()
+        with open(self.path+'.fai', 'w') as fai:
+            for name, length, offset, lineBases, lineWidth, md5 in self.index:
+                print('{}\t{}\t{}\t{}\t{}'.format(name, length, offset, \
+                                                   lineBases, lineWidth), \
+                      file=fai)
+        with open(sequence_dict_path(self.path), 'w') as seqdict:
+            print('@HD\tVN:1.6', file=seqdict)
+            for name, length, offset, lineBases, lineWidth, md5 in self.index:
+                print('@SQ\tSN:{}\tLN:{}\tM5:{}\tUR:file:{}'\
+                      .format(name, length, md5, os.path.abspath(self.path)), \
+                      file=seqdict)
+
+
+class CorrectedFasta(object):
+    """
+    The fasta file of a corrected reference. Scaffolds are handed over as
+    lists of (start, end, bytes) replacements, which are only applied on
+    close(). If no replacement changes the length of a scaffold, close()
+    makes the output a copy of the source fasta patched in place, otherwise
+    all scaffolds are written out with a FastaWriter in reference order.
+    sequences gives access to the source scaffolds, either a dict of
+    DNASequences or an IndexedFasta
+    """
+    
+    def __init__(self, source, sequences, path):
+        self.source = source
+        self.sequences = sequences
+        self.path = path
+        self.replacements = {}
+        self.inPlace = True
+    
+    def add_replacements(self, identifier, replacements):
+        #replacements applied in place may neither overlap nor change lengths
+        cursor = 0
+        for start, end, inserted in replacements:
+            invalid = inserted.translate(None, DNASequence.alphabet)
+            if invalid:
+                raise IncorrectSequenceLetter(chr(invalid[0]), \
+                                              self.__class__.__name__)
+            if start < cursor or end-start != len(inserted):
+                self.inPlace = False
+            cursor = end
+        self.replacements[identifier] = replacements
+    
+    def close(self):
+        if self.inPlace:
+            logging.info('All edits keep the scaffold lengths, patching a '\
+                         'copy of {}'.format(self.source))
+            patch_fasta(self.source, self.path, \
+                        {identifier.split(None, 1)[0]: \
+                         [(start, inserted) for start, end, inserted \
+                          in replacements] \
+                         for identifier, replacements \
+                         in self.replacements.items()})
+            return
+        writer = FastaWriter(self.path)
+        for identifier in self.sequences:
+            if self.replacements.get(identifier):
+                edits = PieceTable(self.sequences[identifier].sequence)
+                for start, end, inserted in self.replacements[identifier]:
+                    edits.replace(start, end, inserted)
+                writer.write_record(identifier, edits.chunks())
+            elif isinstance(self.sequences, IndexedFasta):
+                #untouched scaffolds are copied as they are
+                writer.write_raw(self.sequences, identifier)
+            else:
+                Seq = self.sequences[identifier]
+                writer.write_record(Seq.identifier, [Seq.sequence])
+        writer.close()
+    
+    def write_piece_map(self, path):
+        """
+        write the pieces of the source scaffolds kept by the replacements as
+        scaffold, start, end and start in the corrected scaffold. Scaffolds
+        without replacements are kept as a whole and not listed
+        """
+        with open(path, 'w') as out:
+            print('#scaffold\tstart\tend\tnewStart', file=out)
+            for identifier in self.sequences:
+                replacements = self.replacements.get(identifier)
+                if not replacements:
+                    continue
+                if isinstance(self.sequences, IndexedFasta):
+                    length = self.sequences.length(identifier)
+                else:
+                    length = len(self.sequences[identifier].sequence)
+                name = identifier.split(None, 1)[0]
+                for start, end, newStart in kept_pieces(replacements, length):
+                    print('{}\t{}\t{}\t{}'.format(name, start, end, newStart), \
+                          file=out)
+
+
+class IndexedFasta(object):
+    """
+    Dict-like, read only access to the scaffolds of a fasta file through its
+    .fai index. Sequences are fetched from a memory map of the file on
+    demand and only the last scaffold asked for is kept, so memory scales
+    with the largest scaffold instead of the whole assembly. The index is
+    built if it is missing or older than the fasta file
+    """
+    
+    def __init__(self, fasta_filename):
+        self.path = fasta_filename
+        self.index = load_fai(fasta_filename)
+        self.fd = open(fasta_filename, 'rb')
+        self.map = mmap.mmap(self.fd.fileno(), 0, access=mmap.ACCESS_READ)
+        self.cached = None
+    
+    def __iter__(self):
+        return iter(self.index)
+    
+    def __len__(self):
+        return len(self.index)
+    
+    def __contains__(self, identifier):
+        return identifier in self.index
+    
+    def __getitem__(self, identifier):
+        """
+        return the scaffold as DNASequence
+        """
+        if self.cached is None or self.cached.identifier != identifier:
+            self.cached = None
+            self.cached = DNASequence(identifier, self.fetch(identifier))
+        return self.cached
+    
+    def length(self, identifier):
+        return self.index[identifier][0]
+    
+    def offset(self, identifier, position):
+        """
+        return the file offset of a 0-based position on a scaffold
+        """
+        length, offset, lineBases, lineWidth = self.index[identifier]
+        return offset+(position//lineBases)*lineWidth+position%lineBases
+    
+    def fetch(self, identifier, start=0, end=None):
+        """
+        return the bases [start, end) of a scaffold as bytes
+        """
+        length = self.index[identifier][0]
+        if end is None or end > length:
+            end = length
+        if start >= end:
+            return b''
+        return self.map[self.offset(identifier, start):\
+                        self.offset(identifier, end-1)+1]\
+                        .translate(None, b'\r\n')
+    
+    def bounds(self, identifier):
+        """
+        return the file offsets of the start of the header and the end of
+        the record of a scaffold
+        """
+        length, offset, lineBases, lineWidth = self.index[identifier]
+        headerStart = self.map.rfind(b'\n', 0, offset-1)+1
+        end = offset
+        if length:
+            end = min(len(self.map), self.offset(identifier, length-1)+1+\
+                                     lineWidth-lineBases)
+        return headerStart, end
+    
+    def raw(self, identifier):
+        """
+        return the record of a scaffold as it is in the file, header and
+        line breaks included, as a memoryview
+        """
+        return memoryview(self.map)[slice(*self.bounds(identifier))]
+    
+    def write_raw(self, identifier, out):
+        """
+        copy the record of a scaffold unchanged to a binary file object and
+        return the length of its header line
+        """
+        record = self.raw(identifier)
+        out.write(record)
+        if not record[-1:] == b'\n':
+            out.write(b'\n')
+        record.release()
+        return self.index[identifier][1]-self.bounds(identifier)[0]
+    
+    def close(self):
+        self.cached = None
+        self.map.close()
+        self.fd.close()
+
 
 ###################
 #####FUNCTIONS#####
 ###################
 
 
-def load_fasta(fasta_filename):
+class VcfRecord(object):
+    """
+    The fields of a pysam.VariantRecord raccoon uses, with the meaning PyVCF
+    gave them: REF and ALT as strings (ALT is [None] for '.'), 0-based start
+    and end spanning the REF allele, and PyVCF's is_snp and is_indel
+    classification. INFO and QUAL are decoded only when asked for
+    """
+    
+    __slots__ = ('record', 'CHROM', 'POS', 'REF', 'ALT', 'start', 'end')
+    
+    def __init__(self, record):
+        self.record = record
+        self.CHROM = record.chrom
+        self.POS = record.pos
+        self.REF = record.ref
+        alts = record.alts
+        self.ALT = list(alts) if alts is not None else [None]
+        self.start = self.POS-1
+        self.end = self.start+len(self.REF)
+    
+    @property
+    def QUAL(self):
+        return self.record.qual
+    
+    @property
+    def INFO(self):
+        return self.record.info
+    
+    @property
+    def is_snp(self):
+        if len(self.REF) > 1:
+            return False
+        for alt in self.ALT:
+            if alt not in ('A', 'C', 'G', 'T', 'N', '*'):
+                return False
+        return True
+    
+    @property
+    def is_indel(self):
+        isSV = 'SVTYPE' in self.record.header.info and \
+               self.record.info.get('SVTYPE') is not None
+        if len(self.REF) > 1 and not isSV:
+            return True
+        for alt in self.ALT:
+            if alt is None:
+                return True
+            if alt_type(alt) == 'SV':
+                return False
+            elif len(alt) != len(self.REF):
+                return not isSV
+        return False
+    
+    def genotype(self, sample):
+        return VcfCall(self.record.samples[sample])
 
-        fd = open(fasta_filename,"r")
-        sequence = ""
-        for line in fd:
-                if line[0]==">":
-                        if len(sequence)>0:
-                                try:
-                                        yield DNASequence(identifier, sequence)
-                                except IncorrectSequenceLetter as e:
-                                        logging.warning(e.message)
-                        identifier = line[1:].strip()
-                        sequence = ""
-                else:
-                        sequence+=line.strip()
-        fd.close()
 
-        if len(sequence)>0:
+class VcfCall(object):
+    """
+    The FORMAT fields of one sample of a VcfRecord, with GT as the string
+    PyVCF gave, e.g. '0/1' or '1'
+    """
+    
+    __slots__ = ('call',)
+    
+    def __init__(self, call):
+        self.call = call
+    
+    def __getitem__(self, key):
+        if key != 'GT':
+            return self.call[key]
+        alleles = self.call['GT']
+        return ('|' if self.call.phased else '/')\
+               .join('.' if allele is None else str(allele) \
+                     for allele in alleles)
+
+
+def alt_type(alt):
+    """
+    Returns the type PyVCF gives an ALT allele: 'SV' for symbolic alleles
+    and breakends, 'SNV' for single bases and 'MNV' otherwise
+    """
+    if '[' in alt or ']' in alt or alt[0] == '<' or \
+       (len(alt) > 1 and (alt[0] == '.' or alt[-1] == '.')):
+        return 'SV'
+    return 'SNV' if len(alt) == 1 else 'MNV'
+
+def load_vcf(vcf_filename):
+    """
+    Returns the sample of a vcf or bcf file, plain or bgzipped, along with
+    an iterator of VcfRecords. As PyVCF based code did, the last sample of
+    the header is taken
+    """
+    variants = pysam.VariantFile(vcf_filename)
+    samples = list(variants.header.samples)
+    sample = samples[-1] if samples else None
+    return sample, map(VcfRecord, variants)
+
+#bytes removed from fasta sequence lines
+FASTA_WHITESPACE = b' \t\r\n\x0b\x0c'
+
+def load_fasta(fasta_filename):
+        """
+        Yields the records of a fasta file as DNASequence instances
+        """
+        for identifier, sequence in read_fasta(fasta_filename):
                 try:
                         yield DNASequence(identifier, sequence)
                 except IncorrectSequenceLetter as e:
                         logging.warning(e.message)
 
+def read_fasta(fasta_filename, blockSize=1<<24):
+    """
+    Yields (identifier, sequence) tuples of a fasta file, the sequence as a
+    bytearray of its lines without whitespace. The file is read in large
+    binary blocks whose sequence parts are appended to a single growing
+    buffer, so loading takes linear time. Empty records are skipped
+    """
+    identifier = None
+    sequence = bytearray()
+    carry = b''
+    lineStart = True
+    with open(fasta_filename, 'rb') as fd:
+        while True:
+            data = fd.read(blockSize)
+            eof = not data
+            block = carry+data if carry else data
+            carry = b''
+            pos = 0
+            while True:
+                #headers are the '>' at the start of a line
+                start = block.find(b'>', pos)
+                while start > 0 and block[start-1] != 10 or \
+                      start == 0 and not lineStart:
+                    start = block.find(b'>', start+1)
+                if start < 0:
+                    sequence += block[pos:].translate(None, FASTA_WHITESPACE)
+                    break
+                sequence += block[pos:start].translate(None, FASTA_WHITESPACE)
+                end = block.find(b'\n', start)
+                if end < 0:
+                    if not eof:
+                        #the header continues in the next block
+                        carry = block[start:]
+                        break
+                    end = len(block)
+                if identifier is not None and len(sequence) > 0:
+                    yield identifier, sequence
+                identifier = block[start+1:end].strip().decode()
+                sequence = bytearray()
+                pos = end+1
+            if eof:
+                break
+            lineStart = bool(carry) or block.endswith(b'\n')
+    if identifier is not None and len(sequence) > 0:
+        yield identifier, sequence
+
+def write_wrapped(out, chunks, lineLength=80, linesPerWrite=1<<14):
+    """
+    Write the concatenation of chunks of bytes to a binary file object,
+    wrapped in lines of lineLength. The chunks are never joined, lines are
+    written in batches of linesPerWrite straight from views of the chunks.
+    Nothing but a line break is written for an empty sequence
+    """
+    batch = lineLength*linesPerWrite
+    partial = b''
+    anyLines = False
+    for chunk in chunks:
+        view = memoryview(chunk)
+        start = 0
+        #complete the line left over from the previous chunk
+        if partial:
+            start = lineLength-len(partial)
+            partial += view[:start]
+            if len(partial) < lineLength:
+                continue
+            out.write(partial+b'\n')
+            anyLines = True
+            partial = b''
+        full = start+(len(view)-start)//lineLength*lineLength
+        for batchStart in range(start, full, batch):
+            batchEnd = min(full, batchStart+batch)
+            out.write(b'\n'.join([view[i:i+lineLength] for i in \
+                                  range(batchStart, batchEnd, lineLength)]))
+            out.write(b'\n')
+            anyLines = True
+        partial = bytes(view[full:])
+    if partial or not anyLines:
+        out.write(partial+b'\n')
+
+def copy_file(source, path):
+    """
+    Copy a file, as a reflink sharing the data blocks if the file system
+    supports it
+    """
+    FICLONE = 0x40049409
+    with open(source, 'rb') as src, open(path, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return
+        except OSError:
+            pass
+    shutil.copyfile(source, path)
+
+def kept_pieces(replacements, length):
+    """
+    Returns the pieces of a sequence of the given length that (start, end,
+    bytes) replacements applied as by a PieceTable keep, as (start, end,
+    start in the modified sequence) tuples
+    """
+    pieces = []
+    cursor = 0
+    newLength = 0
+    for start, end, inserted in replacements:
+        if start > cursor:
+            pieces.append((cursor, start, newLength))
+            newLength += start-cursor
+        newLength += len(inserted)
+        cursor = end
+    if cursor < length:
+        pieces.append((cursor, length, newLength))
+    return pieces
+
+def patch_fasta(source, path, patches):
+    """
+    Write a copy of the fasta file source to path in which the bases of the
+    (start, bytes) patches per scaffold are replaced in place through a
+    memory map. The .fai of the source is reused, the sequence dictionary
+    is only hashed anew for patched scaffolds if the source has an up to
+    date one
+    """
+    index = load_fai(source)
+    copy_file(source, path)
+    with open(path+'.fai', 'w') as fai:
+        for identifier, entry in index.items():
+            print('\t'.join([identifier]+[str(i) for i in entry]), file=fai)
+    if any(patches.values()):
+        with open(path, 'r+b') as f:
+            patched = mmap.mmap(f.fileno(), 0)
+            for identifier, scaffoldPatches in patches.items():
+                length, offset, lineBases, lineWidth = index[identifier]
+                for start, inserted in scaffoldPatches:
+                    #patches may run over line breaks
+                    position = start
+                    done = 0
+                    while done < len(inserted):
+                        n = min(len(inserted)-done, \
+                                lineBases-position%lineBases)
+                        fileOffset = offset+(position//lineBases)*lineWidth+\
+                                     position%lineBases
+                        patched[fileOffset:fileOffset+n] = \
+                            inserted[done:done+n]
+                        done += n
+                        position += n
+            patched.flush()
+            patched.close()
+    
+    md5s = {}
+    sourceDict = sequence_dict_path(source)
+    if os.path.exists(sourceDict) and \
+       os.path.getmtime(sourceDict) >= os.path.getmtime(source):
+        with open(sourceDict) as seqdict:
+            for line in seqdict:
+                fields = dict(field.split(':', 1) for field in \
+                              line.rstrip('\n').split('\t')[1:])
+                if line.startswith('@SQ') and 'M5' in fields:
+                    md5s[fields['SN']] = fields['M5']
+    fasta = IndexedFasta(path)
+    with open(sequence_dict_path(path), 'w') as seqdict:
+        print('@HD\tVN:1.6', file=seqdict)
+        for identifier in fasta:
+            if patches.get(identifier) or identifier not in md5s:
+                md5s[identifier] = hash_scaffold(fasta, identifier)
+            print('@SQ\tSN:{}\tLN:{}\tM5:{}\tUR:file:{}'\
+                  .format(identifier, fasta.length(identifier), \
+                          md5s[identifier], os.path.abspath(path)), \
+                  file=seqdict)
+    fasta.close()
+
+def hash_chunks(chunks, md5, step=1<<20):
+    """
+    Yields the chunks of bytes unchanged while feeding their upper case
+    version to an md5 object, the way sequence dictionaries hash bases
+    """
+    for chunk in chunks:
+        view = memoryview(chunk)
+        for start in range(0, len(view), step):
+            md5.update(view[start:start+step].tobytes().upper())
+        yield chunk
+
+def hash_scaffold(fasta, identifier):
+    """
+    Returns the sequence dictionary MD5 sum of a scaffold of an IndexedFasta
+    """
+    length, offset, lineBases, lineWidth = fasta.index[identifier]
+    md5 = hashlib.md5()
+    step = lineBases*(1<<12) or 1
+    for position in range(0, length, step):
+        md5.update(fasta.fetch(identifier, position, position+step).upper())
+    return md5.hexdigest()
+
+def sequence_dict_path(fasta_filename):
+    """
+    Returns the path of the sequence dictionary of a fasta file, which
+    replaces its .fa or .fasta extension by .dict like picard does
+    """
+    return re.sub(r'\.(fa|fasta)$', '', fasta_filename)+'.dict'
+
+def load_fai(fasta_filename):
+    """
+    Returns the .fai index of a fasta file as dict of identifier to length,
+    offset, bases per line and bytes per line, in file order. The index is
+    built if it is missing or older than the fasta file and written next to
+    it if possible
+    """
+    fai = fasta_filename+'.fai'
+    if os.path.exists(fai) and \
+       os.path.getmtime(fai) >= os.path.getmtime(fasta_filename):
+        index = {}
+        with open(fai) as f:
+            for line in f:
+                entry = line.rstrip('\n').split('\t')
+                index[entry[0]] = tuple(map(int, entry[1:5]))
+        return index
+    
+    logging.info('Indexing {}'.format(fasta_filename))
+    index = build_fai(fasta_filename)
+    try:
+        with open(fai, 'w') as f:
+            for identifier, entry in index.items():
+                print('\t'.join([identifier]+[str(i) for i in entry]), file=f)
+    except OSError:
+        logging.warning('Could not write the index {}'.format(fai))
+    return index
+
+def build_fai(fasta_filename):
+    """
+    Returns the samtools faidx compatible index of a fasta file. Like
+    samtools, it requires all lines of a scaffold but the last one to be
+    of the same length
+    """
+    index = {}
+    identifier = None
+    position = 0
+    with open(fasta_filename, 'rb') as f:
+        for line in f:
+            if line.startswith(b'>'):
+                if identifier is not None:
+                    index[identifier] = (length, offset, lineBases or 0, \
+                                         lineWidth or 0)
+                identifier = line[1:].split(None, 1)[0].decode()
+                offset = position+len(line)
+                length = 0
+                lineBases = lineWidth = None
+                short = False
+            elif identifier is not None:
+                bases = len(line.rstrip(b'\r\n'))
+                if lineBases is None:
+                    lineBases = bases
+                    #like samtools, count a missing last line break
+                    lineWidth = len(line) if line.endswith(b'\n') else bases+1
+                elif short and bases or bases > lineBases:
+                    raise ValueError('Different line lengths in scaffold {} '\
+                                     'of {}'.format(identifier, \
+                                                    fasta_filename))
+                short = bases < lineBases
+                length += bases
+            position += len(line)
+    if identifier is not None:
+        index[identifier] = (length, offset, lineBases or 0, lineWidth or 0)
+    return index
+
 def load_fastq(fastqpath):
+    """
+    Yields the records of a (gzipped) fastq file as tuples of four strings
+    """
+    for block in load_fastq_blocks(fastqpath):
+        lines = bytes(block.raw()).decode().split('\n')
+        yield from zip(lines[0::4], lines[1::4], lines[2::4], lines[3::4])
+
+def load_fastq_blocks(fastqpath, blockSize=1<<22):
+    """
+    Yields the records of a (gzipped) fastq file in FastqBlocks, reading
+    blockSize bytes at a time. Records spanning the end of a block are
+    carried over to the next one
+    """
     if fastqpath.endswith('gz') or fastqpath.endswith('gzip'):
         fastqfile=gzip.open(fastqpath,'rb')
     else:
-        fastqfile=open(fastqpath,'r')
-        
-    fastqiter = filter(lambda l: l, fastqfile)  # skip blank lines
-    fastqiter = (l.strip('\n') for l in fastqiter)  # strip trailing newlines
-    while True:
-        values = list(islice(fastqiter, 4))
-        if len(values) == 4:
-            header1,seq,header2,qual = values
-        elif len(values) == 0:
-            raise StopIteration
-        else:
-            raise EOFError("Failed to parse four lines from fastq file!")
+        fastqfile=open(fastqpath,'rb', buffering=0)
+    
+    leftover=b''
+    with fastqfile:
+        while True:
+            data=fastqfile.read(blockSize)
+            if not data:
+                #allow for trailing blank lines and a missing last newline
+                leftover=leftover.rstrip(b'\n')
+                if not leftover:
+                    return
+                data=b'\n'
+            buffer=leftover+data if leftover else data
+            block=parse_fastq_block(buffer)
+            if block is None:
+                if data==b'\n':
+                    raise EOFError("Failed to parse four lines from fastq file!")
+                leftover=buffer
+                continue
+            leftover=buffer[block.lineStarts[-1]:]
+            yield block
 
-        if header1.startswith('@') and header2.startswith('+'):
-            yield header1, seq, header2, qual
-        else:
-            raise ValueError("Invalid header lines: %s and %s" % (header1, header2))
+def parse_fastq_block(buffer):
+    """
+    Parses the complete records at the start of buffer into a FastqBlock.
+    Returns None if buffer doesn't contain a complete record
+    """
+    #the newlines are found in one vectorised scan, no line is copied
+    data=np.frombuffer(buffer, dtype=np.uint8)
+    newlines=np.flatnonzero(data==10)
+    nRecords=len(newlines)//4
+    if nRecords==0:
+        return None
+    lineStarts=np.empty(4*nRecords+1, dtype=np.int64)
+    lineStarts[0]=0
+    lineStarts[1:]=newlines[:4*nRecords]+1
+    
+    #check the records in bulk: header characters and length of seq and qual
+    invalid=(data[lineStarts[0:-1:4]]!=ord('@')) | \
+            (data[lineStarts[2:-1:4]]!=ord('+'))
+    if invalid.any():
+        i=4*int(np.flatnonzero(invalid)[0])
+        raise ValueError("Invalid header lines: {} and {}"\
+                         .format(buffer[lineStarts[i]:lineStarts[i+1]], \
+                                 buffer[lineStarts[i+2]:lineStarts[i+3]]))
+    lineLengths=np.diff(lineStarts)
+    if not np.array_equal(lineLengths[1::4], lineLengths[3::4]):
+        raise ValueError("Sequence and quality of a record differ in length")
+    return FastqBlock(buffer, lineStarts)
         
+def count_fastq_records(fastqpath, blockSize=1<<24):
+    """
+    Returns the number of records in a (gzipped) fastq file by counting
+    newlines in large binary blocks. Unlike grep '^@' this is not fooled by
+    quality strings starting with '@'
+    """
+    if fastqpath.endswith('gz') or fastqpath.endswith('gzip'):
+        fastqfile=gzip.open(fastqpath,'rb')
+    else:
+        fastqfile=open(fastqpath,'rb', buffering=0)
+    
+    nLines=0
+    lastByte=b'\n'
+    with fastqfile:
+        while True:
+            block=fastqfile.read(blockSize)
+            if not block:
+                break
+            nLines+=block.count(b'\n')
+            lastByte=block[-1:]
+    #count a last line without trailing newline
+    if lastByte!=b'\n':
+        nLines+=1
+    if nLines%4:
+        raise EOFError("Number of lines in {} is not a multiple of four!"\
+                       .format(fastqpath))
+    return nLines//4
+
+def count_fastq_bases(fastqpath):
+    """
+    Returns the number of records and bases in a (gzipped) fastq file
+    """
+    nReads=0
+    nBases=0
+    for block in load_fastq_blocks(fastqpath):
+        nReads+=len(block)
+        nBases+=block.bases()
+    return nReads, nBases
+
+def index_fastq(fastqpath, step=4096, blockSize=1<<24):
+    """
+    Builds a sparse record offset index of an uncompressed fastq file.
+    Returns the number of records and an array with the byte offsets of
+    every step-th record, starting with the first one.
+    Newlines are skipped in bulk with bytes.count, so only a handful of
+    python operations are spent per indexed record
+    """
+    offsets=array('Q')
+    nLines=0
+    toSkip=0            #newlines left to skip until the next indexed record
+    blockStart=0
+    lineLength=100.0    #running estimate of the average line length
+    lastByte=b'\n'
+    with open(fastqpath, 'rb', buffering=0) as fastqfile:
+        while True:
+            block=fastqfile.read(blockSize)
+            if not block:
+                break
+            nLines+=block.count(b'\n')
+            lastByte=block[-1:]
+            pos=0
+            blockEnd=len(block)
+            while pos<blockEnd:
+                if toSkip==0:
+                    offsets.append(blockStart+pos)
+                    toSkip=4*step
+                #jump ahead while we're far away from the next record
+                while toSkip>16 and pos<blockEnd:
+                    end=min(pos+max(int(toSkip*lineLength*0.8), 1), blockEnd)
+                    c=block.count(b'\n', pos, end)
+                    if c>=toSkip:
+                        lineLength/=2
+                        continue
+                    if c:
+                        lineLength=(end-pos)/c
+                    toSkip-=c
+                    pos=end
+                #and walk the last few lines
+                while toSkip and pos<blockEnd:
+                    newline=block.find(b'\n', pos)
+                    if newline<0:
+                        pos=blockEnd
+                        break
+                    pos=newline+1
+                    toSkip-=1
+            blockStart+=blockEnd
+    
+    if lastByte!=b'\n':
+        nLines+=1
+    if nLines%4:
+        raise EOFError("Number of lines in {} is not a multiple of four!"\
+                       .format(fastqpath))
+    #a record can't start at the end of the file
+    while offsets and offsets[-1]>=blockStart:
+        offsets.pop()
+    return nLines//4, offsets
+
+def seek_fastq_record(fastqfile, offsets, step, record):
+    """
+    Seeks an open fastq file to the start of a record, reading forward from
+    the closest record before it in a sparse index built by index_fastq.
+    Returns the byte offset of the record
+    """
+    fastqfile.seek(offsets[record//step])
+    for _ in range(4*(record%step)):
+        fastqfile.readline()
+    return fastqfile.tell()
+
+def stream_fastq_range(fastqpath, start, end, out, blockSize=1<<20):
+    """
+    Copies the byte range [start, end) of a fastq file to out
+    """
+    with open(fastqpath, 'rb') as fastqfile:
+        fastqfile.seek(start)
+        remaining=end-start
+        while remaining>0:
+            block=fastqfile.read(min(blockSize, remaining))
+            if not block:
+                break
+            out.write(block)
+            remaining-=len(block)
+
+def interleave_fastq_ranges(fastqpath1, start1, fastqpath2, start2, nReads, out):
+    """
+    Writes nReads pairs starting at the given byte offsets of both mate
+    files to out, interleaved as expected by bwa mem -p
+    """
+    with open(fastqpath1, 'rb') as mates1, open(fastqpath2, 'rb') as mates2:
+        mates1.seek(start1)
+        mates2.seek(start2)
+        for _ in range(nReads):
+            out.write(mates1.readline()+mates1.readline()+\
+                      mates1.readline()+mates1.readline())
+            out.write(mates2.readline()+mates2.readline()+\
+                      mates2.readline()+mates2.readline())
+
+#empty block terminating a BGZF file
+BGZF_EOF=bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+#maximum number of uncompressed bytes in a BGZF block
+BGZF_BLOCK_SIZE=65280
+
+def bgzf_compress(data, level=6):
+    """
+    Compresses data into a series of BGZF blocks, which are plain gzip
+    members carrying their compressed size in an extra field
+    """
+    blocks=[]
+    for start in range(0, len(data), BGZF_BLOCK_SIZE):
+        block=data[start:start+BGZF_BLOCK_SIZE]
+        compressor=zlib.compressobj(level, zlib.DEFLATED, -15)
+        cdata=compressor.compress(block)+compressor.flush()
+        blocks.append(struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6,\
+                                  66, 67, 2, len(cdata)+25))
+        blocks.append(cdata)
+        blocks.append(struct.pack('<2I', zlib.crc32(block), len(block)))
+    return b''.join(blocks)
+
+def gzip_compress(data, level=6):
+    """
+    Compresses data into a single gzip member
+    """
+    return gzip.compress(data, level)
+
+def mate_name(header):
+    """
+    Returns the name of a read from its fastq header, without the leading '@',
+    any comment and the /1 or /2 mate suffix, so both mates compare equal
+    """
+    name=header.split(None, 1)[0].lstrip('@')
+    if name.endswith('/1') or name.endswith('/2'):
+        name=name[:-2]
+    return name
 
 def get_perfect_coverage(Alignments, identifier, start, end):
     """
@@ -179,14 +1157,62 @@ def get_perfect_coverage(Alignments, identifier, start, end):
     Alignments is an instance of a pysam.AlignmentFile
     """
     
-    perfectCoverage=0
-    for read in Alignments.fetch(reference=identifier, start=start, end=end):
-        #check for reads that match over the whole length with no mismatches
-        if read.cigarstring=='{}M'.format(len(read.query_sequence)) and\
-        read.get_tag('NM') <2:
-            perfectCoverage+=1
+    return get_perfect_coverages(Alignments, identifier, [(start, end)])[0]
+
+def perfect_length(read):
+    """
+    Returns the aligned length of a read that matches over its whole length
+    with less than two mismatches (CIGAR: readLengthM), 0 for any other
+    read. The sequence of the read is not decoded
+    """
+    
+    cigar=read.cigartuples
+    if cigar is not None and len(cigar)==1 and cigar[0][0]==0 and \
+       cigar[0][1]==read.query_length and read.get_tag('NM') <2:
+        return cigar[0][1]
+    return 0
+
+def get_perfect_coverages(Alignments, identifier, intervals, maxGap=1<<12):
+    """
+    Returns the number of reads with a full alignment (CIGAR: readLengthM)
+    for each (start, end) intervall on a chromosome, in the order given.
+    Intervalls closer than maxGap are fetched together, so every read is
+    decoded and checked once per window. The start and end positions of the
+    perfect reads are kept sorted and each intervall counts the reads that
+    start before its end minus those ending before its start
+    Alignments is an instance of a pysam.AlignmentFile
+    """
+    
+    counts=[0]*len(intervals)
+    #empty intervalls don't overlap any read
+    order=sorted((i for i in range(len(intervals)) \
+                  if intervals[i][0] < intervals[i][1]), \
+                 key=lambda i: intervals[i][0])
+    first=0
+    while first < len(order):
+        windowStart, windowEnd=intervals[order[first]]
+        last=first+1
+        while last < len(order) and \
+              intervals[order[last]][0]-windowEnd <= maxGap:
+            windowEnd=max(windowEnd, intervals[order[last]][1])
+            last+=1
+        
+        starts=[]
+        ends=[]
+        for read in Alignments.fetch(reference=identifier, start=windowStart, \
+                                     end=windowEnd):
+            length=perfect_length(read)
+            if length:
+                starts.append(read.reference_start)
+                ends.append(read.reference_start+length)
+        #fetch returns the reads sorted by start
+        ends.sort()
+        for i in order[first:last]:
+            start, end=intervals[i]
+            counts[i]=bisect_left(starts, end)-bisect_right(ends, start)
+        first=last
         
-    return perfectCoverage
+    return counts
     
     
 def partition_to_re_chunks(lenghtIndex, nChunks):
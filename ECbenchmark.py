@@ -0,0 +1,464 @@
+#!/usr/bin/env python3
+'''
+Benchmarks of raccoon's parsers against the implementations they replaced.
+Each benchmark generates its own synthetic input unless a file is given.
+'''
+
+import argparse
+import sys
+import os
+import re
+import time
+import random
+import logging
+import tempfile
+from itertools import islice
+from collections import Counter
+import numpy as np
+import pysam
+from ECUtils import load_fastq, load_fastq_blocks, load_fasta, read_fasta, \
+                    DNASequence, IncorrectSequenceLetter, load_vcf
+from ECintegrateVars import VariantColumns, filter_masks
+
+
+###########################
+#####OLD IMPLEMENTATIONS###
+###########################
+
+def legacy_load_fastq(fastqpath):
+    '''
+    the line based fastq parser raccoon used up to now
+    '''
+    fastqfile=open(fastqpath,'r')
+    fastqiter = filter(lambda l: l, fastqfile)  # skip blank lines
+    fastqiter = (l.strip('\n') for l in fastqiter)  # strip trailing newlines
+    while True:
+        values = list(islice(fastqiter, 4))
+        if len(values) == 4:
+            header1,seq,header2,qual = values
+        elif len(values) == 0:
+            return
+        else:
+            raise EOFError("Failed to parse four lines from fastq file!")
+
+        if header1.startswith('@') and header2.startswith('+'):
+            yield header1, seq, header2, qual
+        else:
+            raise ValueError("Invalid header lines: %s and %s" % (header1, header2))
+
+class LegacyDNASequence(object):
+    '''
+    the str based DNASequence raccoon used up to now
+    '''
+    
+    alphabet = set('ACTGNactgn')
+    complement = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A', 'N': 'N',\
+                  'a': 't','c' : 'g', 'g': 'c','t': 'a','n':'n'}
+    
+    def __init__(self, identifier, sequence):
+        self.identifier = identifier
+        self.sequence = sequence
+        
+        for letter in self.sequence:
+            if letter not in self.alphabet:
+                raise IncorrectSequenceLetter(letter,\
+                                              self.__class__.__name__)
+    def __len__(self):
+        return len(self.sequence)
+    
+    def get_fasta_string(self):
+        splitted_seq = []
+        for x in range(0,len(self.sequence),80):
+            splitted_seq.append(self.sequence[x:x+80])
+        return ">%s\n%s\n" %(self.identifier,"\n".join(splitted_seq))
+    
+    def get_revcomplement(self):
+        complementSeq = "".join([ self.complement[letter] for letter in self.sequence ])
+        return LegacyDNASequence(identifier = self.identifier+"_complement",\
+                                 sequence = complementSeq[::-1] )
+
+def legacy_load_fasta(fasta_filename):
+    '''
+    the line based fasta loader raccoon used up to now
+    '''
+    fd = open(fasta_filename,"r")
+    sequence = ""
+    for line in fd:
+        if line[0]==">":
+            if len(sequence)>0:
+                try:
+                    yield LegacyDNASequence(identifier, sequence)
+                except IncorrectSequenceLetter as e:
+                    logging.warning(e.message)
+            identifier = line[1:].strip()
+            sequence = ""
+        else:
+            sequence+=line.strip()
+    fd.close()
+
+    if len(sequence)>0:
+        try:
+            yield LegacyDNASequence(identifier, sequence)
+        except IncorrectSequenceLetter as e:
+            logging.warning(e.message)
+
+def legacy_scan_vcf(vcfpath):
+    '''
+    the PyVCF based parsing of the variant integration up to now, reduced
+    to the fields it looks at
+    '''
+    import vcf
+    sample=None
+    for Record in vcf.Reader(open(vcfpath, 'r')):
+        if sample is None:
+            sample=Record.samples[-1].sample
+        yield scanned_fields(Record, sample, \
+                             [alt.sequence if alt is not None else None \
+                              for alt in Record.ALT])
+
+
+def legacy_passes(Record, qualCutoff, minQD=2):
+    '''
+    the record filters of the variant integration up to now
+    '''
+    if Record.QUAL < qualCutoff:
+        return False
+    #some records have missing QD values for obscure reasons, skip those
+    try:
+        if Record.INFO['QD'] < minQD:
+            return False
+    except:
+        return False
+    return True
+
+def legacy_filter_calls(vcfpath, minSNVqual, minIndelQual):
+    '''
+    the record by record filtering and allel picking of the variant
+    integration up to now. Returns the passing calls as scaffold, start, end
+    and allel, and the counts of integrated and filtered calls
+    '''
+    hetRef=re.compile('0[/\|]\d+')
+    calls=[]
+    counts=Counter()
+    sample, records=load_vcf(vcfpath)
+    for Record in records:
+        genotype=Record.genotype(sample)['GT']
+        if re.match(hetRef, genotype):
+            continue
+        if Record.is_snp and legacy_passes(Record, minSNVqual):
+            counts['INTEGRATED SNV']+=1
+        elif Record.is_indel and legacy_passes(Record, minIndelQual):
+            counts['INTEGRATED INDELS']+=1
+        else:
+            counts['FILTERED VARS']+=1
+            continue
+        if len(genotype)==1 or len(Record.ALT)==1:
+            variant=Record.ALT[0]
+        else:
+            allelicDepths=Record.genotype(sample)['AD']
+            variant=Record.ALT[allelicDepths.index(max(allelicDepths))-1]
+        calls.append((Record.CHROM, Record.start, Record.end, variant))
+    return calls, counts
+
+
+###################
+#####FUNCTIONS#####
+###################
+
+def timed(label, function, size):
+    '''
+    run function, report its throughput and return its result
+    '''
+    start=time.time()
+    result=function()
+    elapsed=time.time()-start
+    print('{:<40}{:>10.2f} s{:>12.1f} MB/s'.format(label, elapsed, \
+                                                 size/elapsed/1e6 if elapsed else 0))
+    return result
+
+def write_fastq(path, nReads, readLength=150):
+    random.seed(42)
+    bases='ACGT'
+    with open(path, 'w') as out:
+        for i in range(nReads):
+            seq=''.join(random.choice(bases) for _ in range(readLength))
+            out.write('@read{}/1\n{}\n+\n{}\n'.format(i, seq, 'I'*readLength))
+
+def write_fasta(path, nScaffolds, scaffoldLength, lineLength=60):
+    random.seed(42)
+    toBases=bytes.maketrans(bytes(range(256)), b'ACGT'*64)
+    with open(path, 'wb') as out:
+        for i in range(nScaffolds):
+            seq=random.randbytes(scaffoldLength).translate(toBases)
+            out.write('>scaffold{}\n'.format(i).encode())
+            for start in range(0, scaffoldLength, lineLength):
+                out.write(seq[start:start+lineLength]+b'\n')
+
+def write_vcf(path, nRecords, nScaffolds=20):
+    random.seed(42)
+    bases='ACGT'
+    perScaffold=-(-nRecords//nScaffolds)
+    with open(path, 'w') as out:
+        out.write('##fileformat=VCFv4.2\n')
+        for i in range(nScaffolds):
+            out.write('##contig=<ID=scaffold{},length={}>\n'\
+                      .format(i, perScaffold*20+100))
+        out.write('##INFO=<ID=QD,Number=1,Type=Float,Description="QD">\n'\
+                  '##INFO=<ID=DP,Number=1,Type=Integer,Description="DP">\n'\
+                  '##FORMAT=<ID=GT,Number=1,Type=String,Description="GT">\n'\
+                  '##FORMAT=<ID=AD,Number=R,Type=Integer,Description="AD">\n'\
+                  '##FORMAT=<ID=DP,Number=1,Type=Integer,Description="DP">\n'\
+                  '##FORMAT=<ID=GQ,Number=1,Type=Integer,Description="GQ">\n'\
+                  '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t'\
+                  'sample\n')
+        for n in range(nRecords):
+            ref=random.choice(bases)
+            kind=random.random()
+            if kind < 0.7:
+                alts=[random.choice(bases.replace(ref, ''))]
+            elif kind < 0.85:
+                alts=[ref+''.join(random.choice(bases) \
+                                  for _ in range(random.randint(1, 5)))]
+            elif kind < 0.95:
+                ref+=''.join(random.choice(bases) \
+                             for _ in range(random.randint(1, 5)))
+                alts=[ref[0]]
+            else:
+                alts=[ref+'A', ref+'CC']
+            gt=random.choice(['1/1', '1/1', '0/1', '1'] if len(alts)==1 \
+                             else ['1/2'])
+            ad=','.join(str(random.randint(0, 30)) for _ in range(len(alts)+1))
+            out.write('scaffold{}\t{}\t.\t{}\t{}\t{:.2f}\t.\t'\
+                      'DP={};QD={:.2f}\tGT:AD:DP:GQ\t{}:{}:{}:{}\n'\
+                      .format(n//perScaffold, 20*(n%perScaffold)+1, ref, \
+                              ','.join(alts), random.uniform(0, 500), \
+                              random.randint(1, 60), random.uniform(0, 30), \
+                              gt, ad, random.randint(1, 60), \
+                              random.randint(1, 99)))
+
+def scanned_fields(Record, sample, alts):
+    '''
+    what integrate_variants reads from a record
+    '''
+    try:
+        qd=Record.INFO['QD']
+    except (KeyError, ValueError):
+        qd=None
+    call=Record.genotype(sample)
+    ad=call['AD']
+    #htslib keeps QUAL and float INFO values in single precision
+    qual=Record.QUAL
+    return Record.CHROM, Record.start, Record.end, Record.REF, alts, \
+           round(qual, 3) if qual is not None else None, \
+           round(qd, 3) if qd is not None else None, call['GT'], \
+           tuple(ad) if ad is not None else None, \
+           Record.is_snp, Record.is_indel
+
+def scan_vcf(vcfpath):
+    sample, records=load_vcf(vcfpath)
+    for Record in records:
+        yield scanned_fields(Record, sample, Record.ALT)
+
+def benchmark_vcf(args):
+    path=args.input
+    if path is None:
+        path=os.path.join(args.tmpdir, 'benchmark.vcf')
+        logging.info('Writing {} synthetic variants to {}'.format(args.n, path))
+        write_vcf(path, args.n)
+    size=os.path.getsize(path)
+    
+    new=timed('load_vcf (pysam.VariantFile)', \
+              lambda: list(scan_vcf(path)), size)
+    if path.endswith('.vcf'):
+        compressed=pysam.tabix_index(path, preset='vcf', keep_original=True, \
+                                     force=True)
+        timed('load_vcf, bgzipped', lambda: sum(1 for _ in scan_vcf(compressed)),\
+              size)
+        os.remove(compressed)
+        os.remove(compressed+'.tbi')
+    try:
+        import vcf
+    except ImportError:
+        logging.warning('PyVCF is not installed, skipping the legacy parser')
+    else:
+        old=timed('legacy PyVCF Reader', \
+                  lambda: list(legacy_scan_vcf(path)), size)
+        if old!=new:
+            logging.error('The parsers disagree on the variants')
+            sys.exit(1)
+    if args.input is None:
+        os.remove(path)
+
+def filter_calls(vcfpath, minSNVqual, minIndelQual):
+    '''
+    the column filtering and allel picking of integrate_variants, with
+    results as legacy_filter_calls returns them
+    '''
+    Calls=VariantColumns(vcfpath)
+    considered, snvPass, indelPass=filter_masks(Calls, minSNVqual, \
+                                                minIndelQual)
+    passing=snvPass | indelPass
+    calls=[(Calls.chroms[Calls.chrom[i]], int(Calls.start[i]), \
+            int(Calls.start[i])+int(Calls.refLength[i]), Calls.allele(i)) \
+           for i in np.flatnonzero(passing).tolist()]
+    counts=Counter({'INTEGRATED SNV':    int(np.count_nonzero(snvPass)), \
+                    'INTEGRATED INDELS': int(np.count_nonzero(indelPass)), \
+                    'FILTERED VARS':     int(np.count_nonzero(considered & \
+                                                              ~passing))})
+    return calls, counts
+
+def benchmark_calls(args):
+    path=args.input
+    if path is None:
+        path=os.path.join(args.tmpdir, 'benchmark.calls.vcf')
+        logging.info('Writing {} synthetic variants to {}'.format(args.n, path))
+        write_vcf(path, args.n)
+    size=os.path.getsize(path)
+    
+    new=timed('filtering on columns', \
+              lambda: filter_calls(path, args.minSNVQ, args.minIndelQ), size)
+    old=timed('legacy filtering record by record', \
+              lambda: legacy_filter_calls(path, args.minSNVQ, \
+                                          args.minIndelQ), size)
+    if old!=new:
+        logging.error('The filters disagree on the calls')
+        sys.exit(1)
+    logging.info('Both filters pass the same {} calls'.format(len(new[0])))
+    if args.input is None:
+        os.remove(path)
+
+def benchmark_fasta(args):
+    path=args.input
+    if path is None:
+        path=os.path.join(args.tmpdir, 'benchmark.fa')
+        logging.info('Writing {} synthetic scaffolds of {} bp to {}'\
+                     .format(args.n, args.length, path))
+        write_fasta(path, args.n, args.length)
+    size=os.path.getsize(path)
+
+    old=timed('legacy load_fasta', \
+              lambda: [len(s) for s in legacy_load_fasta(path)], size)
+    new=timed('load_fasta (block reader)', \
+              lambda: [len(s) for s in load_fasta(path)], size)
+    raw=timed('read_fasta, no validation', \
+              lambda: [len(s) for _, s in read_fasta(path)], size)
+    if not old==new==raw:
+        logging.error('The loaders disagree on the sequence lengths')
+        sys.exit(1)
+    
+    #per base work on the loaded sequences
+    oldSeqs=list(legacy_load_fasta(path))
+    newSeqs=list(load_fasta(path))
+    timed('legacy DNASequence validation', \
+          lambda: [LegacyDNASequence(s.identifier, s.sequence) \
+                   for s in oldSeqs], size)
+    timed('DNASequence validation', \
+          lambda: [DNASequence(s.identifier, s.sequence) for s in newSeqs], size)
+    oldRc=timed('legacy get_revcomplement', \
+                lambda: [s.get_revcomplement().sequence for s in oldSeqs], size)
+    newRc=timed('get_revcomplement', \
+                lambda: [s.get_revcomplement().sequence for s in newSeqs], size)
+    def legacy_writing():
+        with open(os.devnull, 'w') as out:
+            for s in oldSeqs:
+                out.write(s.get_fasta_string())
+    def writing():
+        with open(os.devnull, 'wb') as out:
+            for s in newSeqs:
+                s.write_fasta(out)
+    timed('legacy get_fasta_string writing', legacy_writing, size)
+    timed('write_fasta', writing, size)
+    if [rc.encode() for rc in oldRc]!=newRc:
+        logging.error('The reverse complements differ')
+        sys.exit(1)
+    if args.input is None:
+        os.remove(path)
+
+def benchmark_fastq(args):
+    path=args.input
+    if path is None:
+        path=os.path.join(args.tmpdir, 'benchmark.fq')
+        logging.info('Writing {} synthetic reads to {}'.format(args.n, path))
+        write_fastq(path, args.n)
+    size=os.path.getsize(path)
+
+    old=timed('legacy load_fastq', \
+              lambda: sum(1 for _ in legacy_load_fastq(path)), size)
+    new=timed('load_fastq (block parser)', \
+              lambda: sum(1 for _ in load_fastq(path)), size)
+    views=timed('load_fastq_blocks, record views', \
+                lambda: sum(1 for block in load_fastq_blocks(path) \
+                            for _ in block), size)
+    raw=timed('load_fastq_blocks, raw passthrough', \
+              lambda: sum(len(block) for block in load_fastq_blocks(path)), size)
+    #what the setup stage does with the records: write them to chunk files
+    def legacy_chunking():
+        with open(os.devnull, 'w') as out:
+            for read in legacy_load_fastq(path):
+                out.write('\n'.join(read)+'\n')
+    def raw_chunking():
+        with open(os.devnull, 'wb') as out:
+            for block in load_fastq_blocks(path):
+                out.write(block.raw())
+    timed('legacy load_fastq, chunk writing', legacy_chunking, size)
+    timed('load_fastq_blocks, raw chunk writing', raw_chunking, size)
+    if not old==new==views==raw:
+        logging.error('The parsers disagree on the number of records: '\
+                      '{} {} {} {}'.format(old, new, views, raw))
+        sys.exit(1)
+    #the record views hold the very lines the legacy parser returns
+    records=(tuple(bytes(line).decode() for line in record) \
+             for block in load_fastq_blocks(path) for record in block)
+    if any(record!=legacyRecord for record, legacyRecord \
+           in zip(records, legacy_load_fastq(path))):
+        logging.error('The record views differ from the legacy records')
+        sys.exit(1)
+    if args.input is None:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+
+    logFormat = "%(asctime)s [%(levelname)s] %(message)s"
+    logging.basicConfig(stream=sys.stderr, format=logFormat, level='INFO')
+
+    #parse arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-tmpdir', type=str, default=tempfile.gettempdir())
+    subparsers=parser.add_subparsers(dest='benchmark')
+    subparsers.required=True
+
+    fastq=subparsers.add_parser('fastq', help='fastq parsing')
+    fastq.add_argument('-input', type=str, default=None, \
+                       help='uncompressed fastq file, synthetic if omitted')
+    fastq.add_argument('-n', type=int, default=1000000, \
+                       help='number of synthetic reads')
+    fastq.set_defaults(function=benchmark_fastq)
+
+    fasta=subparsers.add_parser('fasta', help='fasta loading')
+    fasta.add_argument('-input', type=str, default=None, \
+                       help='fasta file, synthetic if omitted')
+    fasta.add_argument('-n', type=int, default=4, \
+                       help='number of synthetic scaffolds')
+    fasta.add_argument('-length', type=int, default=50000000, \
+                       help='length of the synthetic scaffolds')
+    fasta.set_defaults(function=benchmark_fasta)
+
+    vcfParser=subparsers.add_parser('vcf', help='vcf parsing')
+    vcfParser.add_argument('-input', type=str, default=None, \
+                           help='vcf file, synthetic if omitted')
+    vcfParser.add_argument('-n', type=int, default=1000000, \
+                           help='number of synthetic variants')
+    vcfParser.set_defaults(function=benchmark_vcf)
+
+    calls=subparsers.add_parser('calls', help='variant call filtering')
+    calls.add_argument('-input', type=str, default=None, \
+                       help='vcf file, synthetic if omitted')
+    calls.add_argument('-n', type=int, default=1000000, \
+                       help='number of synthetic variants')
+    calls.add_argument('-minSNVQ', type=int, default=30)
+    calls.add_argument('-minIndelQ', type=int, default=30)
+    calls.set_defaults(function=benchmark_calls)
+
+    args=parser.parse_args()
+    args.function(args)
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+'''
+Persisted perfect read coverage of a bam file. For every scaffold the start
+positions of the perfect reads (see ECUtils.perfect_length) are stored in
+sorted order along with their ends, and the ends once more in sorted order.
+These are the prefix sums of the per base difference arrays, so coverage
+queries are binary searches on memory mapped .npy files instead of fetches
+from the bam.
+'''
+
+import argparse
+import sys
+import os
+import logging
+import shutil
+from array import array
+import numpy as np
+import pysam
+from ECUtils import perfect_length
+
+ARRAYS = ('starts', 'ends', 'sortedEnds')
+
+
+class CoverageTrack(object):
+    '''
+    The perfect read coverage track written by build_coverage_track, with
+    the arrays memory mapped
+    '''
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        #scaffold to offset, number of reads and longest read
+        self.index = {}
+        with open(prefix+'.index.tsv') as index:
+            for line in index:
+                identifier, offset, nReads, maxLength = \
+                    line.rstrip('\n').split('\t')
+                self.index[identifier] = (int(offset), int(nReads), \
+                                          int(maxLength))
+        for name in ARRAYS:
+            setattr(self, name, np.load('{}.{}.npy'.format(prefix, name), \
+                                        mmap_mode='r'))
+
+    def __contains__(self, identifier):
+        return identifier in self.index
+
+    def scaffold(self, identifier):
+        '''
+        the starts, ends and sorted ends of the perfect reads on a scaffold
+        and its longest read
+        '''
+        offset, nReads, maxLength = self.index.get(identifier, (0, 0, 0))
+        return self.starts[offset:offset+nReads], \
+               self.ends[offset:offset+nReads], \
+               self.sortedEnds[offset:offset+nReads], maxLength
+
+    def overlapping(self, identifier, starts, ends):
+        '''
+        numbers of perfect reads overlapping the intervalls [start, end),
+        as get_perfect_coverage counts them. starts and ends are array likes
+        '''
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        readStarts, readEnds, sortedEnds, maxLength = self.scaffold(identifier)
+        counts = np.searchsorted(readStarts, ends, 'left')-\
+                 np.searchsorted(sortedEnds, starts, 'right')
+        #empty intervalls don't overlap any read
+        counts[starts >= ends] = 0
+        return counts
+
+    def spanning(self, identifier, starts, ends, batchSize=1<<16):
+        '''
+        numbers of perfect reads fully spanning the intervalls [start, end).
+        Only reads starting no further than the longest read before the end
+        can span an intervall. The windows of these reads are concatenated
+        for batchSize queries at a time and compared to the ends in one go
+        '''
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        readStarts, readEnds, sortedEnds, maxLength = self.scaffold(identifier)
+        lows = np.searchsorted(readStarts, ends-maxLength, 'left')
+        highs = np.searchsorted(readStarts, starts, 'right')
+        sizes = np.maximum(highs-lows, 0)
+        counts = np.zeros(len(starts), dtype=np.int64)
+        for first in range(0, len(starts), batchSize):
+            batch = slice(first, first+batchSize)
+            size = sizes[batch]
+            bounds = np.cumsum(size)
+            #read indices of all windows, each window shifted from its place
+            #in the concatenation to its low
+            reads = np.arange(bounds[-1] if len(bounds) else 0)+\
+                    np.repeat(lows[batch]-(bounds-size), size)
+            spans = np.concatenate(([0], np.cumsum(readEnds[reads] >= \
+                                                   np.repeat(ends[batch], \
+                                                             size))))
+            counts[batch] = spans[bounds]-spans[bounds-size]
+        return counts
+
+    def depth(self, identifier, positions):
+        '''
+        numbers of perfect reads covering single positions
+        '''
+        positions = np.asarray(positions, dtype=np.int64)
+        return self.overlapping(identifier, positions, positions+1)
+
+    def perfect_coverages(self, identifier, intervals):
+        '''
+        drop in replacement of ECUtils.get_perfect_coverages
+        '''
+        if not intervals:
+            return []
+        starts, ends = zip(*intervals)
+        return self.overlapping(identifier, starts, ends).tolist()
+
+
+def track_prefix(bam):
+    '''
+    the default prefix of the coverage track of a bam file
+    '''
+    if bam.endswith('.bam'):
+        bam = bam[:-len('.bam')]
+    return bam+'.perfect'
+
+def build_coverage_track(bam, prefix, threads=1):
+    '''
+    write the perfect read coverage track of a coordinate sorted bam file
+    in one pass over it
+    '''
+
+    logging.info('Building perfect read coverage track of {}'.format(bam))
+    raws = {name: open('{}.{}.raw'.format(prefix, name), 'wb') \
+            for name in ARRAYS}
+    index = []
+    offset = 0
+
+    def flush(identifier, starts, ends):
+        starts = np.frombuffer(starts, dtype=np.int64)
+        ends = np.frombuffer(ends, dtype=np.int64)
+        if np.any(starts[1:] < starts[:-1]):
+            logging.critical('{} is not sorted by coordinate'.format(bam))
+            sys.exit(1)
+        raws['starts'].write(starts.tobytes())
+        raws['ends'].write(ends.tobytes())
+        raws['sortedEnds'].write(np.sort(ends).tobytes())
+        index.append((identifier, offset, len(starts), \
+                      int((ends-starts).max()) if len(starts) else 0))
+        return offset+len(starts)
+
+    with pysam.AlignmentFile(bam, 'rb', threads=threads) as alignments:
+        referenceId = None
+        starts = array('q')
+        ends = array('q')
+        for read in alignments.fetch(until_eof=True):
+            #unmapped reads come last
+            if read.reference_id < 0:
+                break
+            if read.reference_id != referenceId:
+                if referenceId is not None:
+                    offset = flush(alignments.get_reference_name(referenceId),\
+                                   starts, ends)
+                    starts = array('q')
+                    ends = array('q')
+                referenceId = read.reference_id
+            length = perfect_length(read)
+            if length:
+                starts.append(read.reference_start)
+                ends.append(read.reference_start+length)
+        if referenceId is not None:
+            offset = flush(alignments.get_reference_name(referenceId), \
+                           starts, ends)
+
+    #prepend the .npy headers to the raw arrays
+    for name, raw in raws.items():
+        raw.close()
+        with open('{}.{}.npy'.format(prefix, name), 'wb') as npy, \
+             open(raw.name, 'rb') as data:
+            np.lib.format.write_array_header_1_0(npy, \
+                {'descr': np.dtype(np.int64).str, 'fortran_order': False, \
+                 'shape': (offset,)})
+            shutil.copyfileobj(data, npy)
+        os.remove(raw.name)
+    #the index is written last and marks the track as complete
+    with open(prefix+'.index.tsv', 'w') as out:
+        for entry in index:
+            print('\t'.join(map(str, entry)), file=out)
+
+def load_coverage_track(bam, prefix=None, threads=1):
+    '''
+    Returns the CoverageTrack of a bam file, building it if it is missing or
+    older than the bam file
+    '''
+    if prefix is None:
+        prefix = track_prefix(bam)
+    index = prefix+'.index.tsv'
+    if not os.path.exists(index) or \
+       os.path.getmtime(index) < os.path.getmtime(bam):
+        build_coverage_track(bam, prefix, threads)
+    return CoverageTrack(prefix)
+
+
+if __name__ == '__main__':
+
+    logFormat = "%(asctime)s [%(levelname)s] %(message)s"
+    logging.basicConfig(stream=sys.stderr, format=logFormat, level='INFO')
+
+    #parse arguments
+    parser = argparse.ArgumentParser()
+    subparsers=parser.add_subparsers(dest='command')
+    subparsers.required=True
+
+    build=subparsers.add_parser('build', help='build the track of a bam file')
+    build.add_argument('bam', type=str)
+    build.add_argument('-prefix', type=str, default=None, \
+                       help='prefix of the track files, defaults to the bam '\
+                       'file with .perfect instead of .bam')
+    build.add_argument('-threads', type=int, default=1, \
+                       help='threads decompressing the alignments')
+
+    query=subparsers.add_parser('query', help='perfect coverage of the '\
+                                'intervalls in a bed file')
+    query.add_argument('prefix', type=str)
+    query.add_argument('bed', type=str)
+    query.add_argument('-spanning', action='store_true', \
+                       help='only count reads that span the whole intervall')
+    args=parser.parse_args()
+
+    if args.command=='build':
+        prefix=args.prefix if args.prefix is not None else track_prefix(args.bam)
+        build_coverage_track(args.bam, prefix, args.threads)
+    else:
+        Track=CoverageTrack(args.prefix)
+        intervals=[]
+        with open(args.bed) as bed:
+            for line in bed:
+                if line.startswith(('#', 'track', 'browser')) or not line.strip():
+                    continue
+                identifier, start, end=line.split('\t')[:3]
+                intervals.append((identifier, int(start), int(end)))
+        #query all intervalls of a scaffold at once, report in input order
+        counts=[0]*len(intervals)
+        byScaffold={}
+        for i, (identifier, start, end) in enumerate(intervals):
+            byScaffold.setdefault(identifier, []).append(i)
+        for identifier, indices in byScaffold.items():
+            starts=[intervals[i][1] for i in indices]
+            ends=[intervals[i][2] for i in indices]
+            if args.spanning:
+                scaffoldCounts=Track.spanning(identifier, starts, ends)
+            else:
+                scaffoldCounts=Track.overlapping(identifier, starts, ends)
+            for i, count in zip(indices, scaffoldCounts):
+                counts[i]=count
+        for (identifier, start, end), count in zip(intervals, counts):
+            print('{}\t{}\t{}\t{}'.format(identifier, start, end, count))
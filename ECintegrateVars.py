@@ -2,42 +2,49 @@
 
 import sys
 import os
-import re
 import logging
-import vcf
 from ECUtils import *
 import argparse
 import pysam
+import numpy as np
+from array import array
 from collections import defaultdict
 from collections import Counter
+from functools import partial
+from multiprocessing import get_context
+from ECvarTrack import VarTrackWriter, VarTrack
 
-class SNVFilter(vcf.filters.Base):
+#the IntegrateTrackVariants of a worker process, set up by init_worker
+workerIntegration=None
+
+#variant types of the VariantColumns
+OTHER=0
+SNP=1
+INDEL=2
+
+class SNVFilter(object):
     '''
     controlls pass filtering for snv
     filtersettings are hardcoded class attribtues..
-    filters simply return true for pass and false for fail
+    filter masks are true for passing calls
 
     '''
     #MIN_QUAL=30     #minimum variant qual (phred)
     MIN_QD=2        #minimum quality by depth
     def __init__(self):
         pass
-    def __call__(self, Record, qualCutoff):
-        if Record.QUAL < qualCutoff:  return False
-        #some records have missing QD values for obscure reasons, skip those
-        try:
-            if Record.INFO['QD'] < self.MIN_QD:  return False
-        except:
-            logging.warning('Missing QD field!')
-            return False
-
-        return True
     
-class IndelFilter(vcf.filters.Base):
+    def mask(self, Calls, qualCutoff):
+        '''
+        the filter applied to all VariantColumns at once, missing values fail
+        '''
+        return (Calls.qual >= qualCutoff) & (Calls.qd >= self.MIN_QD)
+    
+class IndelFilter(object):
     '''
     controlls pass filtering for indels
     filtersettings are hardcoded class attribtues..
-    filters simply return true for pass and false for fail
+    filter masks are true for passing calls
 
     '''
     #MIN_QUAL=30     #minimum variant qual (phred)
@@ -47,187 +54,280 @@ class IndelFilter(vcf.filters.Base):
     def __init__(self):
         pass
     
-    def __call__(self, Record, qualCutoff):
-        if Record.QUAL < qualCutoff: return False
-        #some records have missing QD values for obscure reasons, skip those
-        try:
-            if Record.INFO['QD'] < self.MIN_QD:  return False
-        except:
-            logging.warning('Missing QD field!')
-            return False
-        # add 1 to maxlen as the representaiton includes
-        # 1 base upstream by vcf specification
-     #   if len(Record.REF) > self.MAXLEN+1:    return False #should this really
-     #   for i in Record.ALT:                                #be that absolute?
-     #       if len(i.sequence)>self.MAXLEN+1:  return False        
+    def mask(self, Calls, qualCutoff):
+        '''
+        the filter applied to all VariantColumns at once, missing values fail
+        '''
+        return (Calls.qual >= qualCutoff) & (Calls.qd >= self.MIN_QD)
+    
+    
+class VariantColumns(object):
+    '''
+    The calls of a vcf file as columns: scaffold, start and REF length,
+    QUAL and QD (nan if missing), variant type and whether the genotype is
+    heterozygous with the reference allel. REF and the ALT allel that would
+    be integrated are kept in byte heaps. Records are only read once, all
+    filtering is done on the columns
+    '''
+    
+    def __init__(self, vcfFile):
+        self.chroms=[]
+        chromCodes={}
+        chrom=array('i')
+        start=array('q')
+        refLength=array('i')
+        qual=array('d')
+        qd=array('d')
+        kind=array('b')
+        hetRef=array('b')
+        self.refs=bytearray()
+        self.refOffsets=array('q', [0])
+        self.alleles=bytearray()
+        self.alleleOffsets=array('q', [0])
+        #calls whose allel can't be picked for lack of allelic depths
+        self.unpicked=set()
+        
+        sample, records=load_vcf(vcfFile)
+        nan=float('nan')
+        for Record in records:
+            code=chromCodes.get(Record.CHROM)
+            if code is None:
+                code=chromCodes[Record.CHROM]=len(self.chroms)
+                self.chroms.append(Record.CHROM)
+            chrom.append(code)
+            start.append(Record.start)
+            refLength.append(len(Record.REF))
+            recordQual=Record.QUAL
+            qual.append(nan if recordQual is None else recordQual)
+            try:
+                qd.append(Record.INFO['QD'])
+            except (KeyError, ValueError, TypeError):
+                qd.append(nan)
+            kind.append(SNP if Record.is_snp else \
+                        INDEL if Record.is_indel else OTHER)
+            
+            #the hetRef regex 0[/|]\d+ on the genotype string
+            call=Record.record.samples[sample]
+            alleles=call['GT']
+            hetRef.append(len(alleles) > 1 and alleles[0]==0 and \
+                          alleles[1] is not None)
+            
+            # check if were dealing with a haploid sample
+            # (hack-ishly) and just take the alt if so, if it is
+            # homozygous alt, just integrate alt:
+            allele=Record.ALT[0]
+            if len(alleles) > 1 and len(Record.ALT) > 1:
+                #mayority rule pick from AD tag (allelic depth
+                try:
+                    allelicDepths=call['AD']
+                    maxDepth=allelicDepths.index(max(allelicDepths))
+                    allele=Record.ALT[maxDepth-1] #to index the Record ALT list
+                except (KeyError, ValueError, TypeError):
+                    allele=None
+            self.refs+=Record.REF.encode()
+            self.refOffsets.append(len(self.refs))
+            if allele is None:
+                self.unpicked.add(len(chrom)-1)
+            else:
+                self.alleles+=allele.encode()
+            self.alleleOffsets.append(len(self.alleles))
         
-        return True
+        self.chrom=np.frombuffer(chrom, dtype=np.int32)
+        self.start=np.frombuffer(start, dtype=np.int64)
+        self.refLength=np.frombuffer(refLength, dtype=np.int32)
+        self.qual=np.frombuffer(qual, dtype=np.float64)
+        self.qd=np.frombuffer(qd, dtype=np.float64)
+        self.kind=np.frombuffer(kind, dtype=np.int8)
+        self.hetRef=np.frombuffer(hetRef, dtype=np.int8).astype(bool)
+    
+    def __len__(self):
+        return len(self.chrom)
+    
+    def ref(self, i):
+        return self.refs[self.refOffsets[i]:self.refOffsets[i+1]].decode()
+    
+    def allele(self, i):
+        '''
+        the ALT allel of call i to integrate, None if it can't be picked
+        '''
+        if i in self.unpicked:
+            return None
+        return self.alleles[self.alleleOffsets[i]:\
+                            self.alleleOffsets[i+1]].decode()
     
     
 class IntegrateTrackVariants(object):
     
     def __init__(self, reference, variantFiles, mappings,\
-                 outPrefix, minSNVqual, minIndelQual):
+                 outPrefix, minSNVqual, minIndelQual, lazy=False, threads=1,\
+                 coverageTrack=False, processes=1):
         
         self.reference=     reference
         self.variantFiles=  variantFiles
-        self.mappings=      pysam.AlignmentFile(mappings, 'rb')
+        self.mappings=      None
         self.outPrefix=     outPrefix
         self.minSNVqual=    minSNVqual
         self.minIndelQual=  minIndelQual
+        self.coverageTrack= coverageTrack
         
 
         self.sequenceDict={}
         self.outTracker=set()
         self.statTracker=defaultdict(int)
-        self.varTrack=open(os.path.join(outPrefix,\
-                                        'varTrack.tsv'),'w')
+        #binary track of the inserted variants
+        self.varTrack=VarTrackWriter(os.path.join(outPrefix, 'varTrack'))
         self.statCounter=Counter()
+        
+        #look up perfect coverage in the persisted track of the alignments
+        #or in the alignments themselves, opened by open_alignments
+        if coverageTrack:
+            from ECcoverageTrack import load_coverage_track
+            self.perfect_coverages=load_coverage_track(mappings, \
+                                   threads=threads).perfect_coverages
 
-        #load reference
-        logging.info("Loading reference")        
-
-        for sequence in load_fasta(reference):
-            self.sequenceDict[sequence.identifier]=sequence
+        #load reference, or fetch its scaffolds on demand in lazy mode
+        if lazy:
+            logging.info("Opening indexed reference")
+            self.sequenceDict=IndexedFasta(reference)
+        else:
+            logging.info("Loading reference")
+            for sequence in load_fasta(reference):
+                self.sequenceDict[sequence.identifier]=sequence
         
-        #open file to track inserted variants
-        self.varTracker=open(os.path.join(outPrefix,\
-                                        'varTrack.tsv'),'w')
-        #open file to write modified fastas
-        self.varIntegration=open(os.path.join(outPrefix, \
-                                              'reference.varcall.integrated.fa'),'w')
+        #open file to write modified fastas, indexed on the way, or patched
+        #into a copy of the reference if all edits keep the lengths
+        self.varIntegration=CorrectedFasta(reference, self.sequenceDict, \
+                                           os.path.join(outPrefix, \
+                                           'reference.varcall.integrated.fa'))
         
-        for vcfFile in self.variantFiles.split(","):
-            modScaffs, stats=self.integrate_variants(vcfFile)
-            self.outTracker=self.outTracker.union(modScaffs)
-            self.statCounter+=stats
+        vcfFiles=[vcfFile for vcfFile in self.variantFiles.split(",") \
+                  if vcfFile]
+        #the threads are split among the processes that have a vcf to work on
+        processes=max(1, min(processes, len(vcfFiles)))
+        if processes > 1:
+            #the chunk vcfs cover disjoint scaffolds, so they are integrated
+            #independently and their varTrack fragments concatenated. The
+            #workers are forked to share the loaded reference, and open the
+            #alignments themselves: a threaded htslib handle of the parent
+            #can't be closed in a forked child, its thread pool is gone
+            logging.info('integrating {} vcf files in {} processes'\
+                         .format(len(vcfFiles), processes))
+            workerThreads=max(1, threads//processes)
+            with get_context('fork').Pool(processes, initializer=init_worker, \
+                 initargs=(self, mappings, workerThreads)) as pool:
+                for fragment, replacements, stats in \
+                    pool.imap(integrate_chunk, enumerate(vcfFiles)):
+                    self.varTrack.extend(VarTrack(fragment))
+                    for suffix in ('.npy', '.alleles', '.index.tsv'):
+                        os.remove(fragment+suffix)
+                    self.add_replacements(replacements, stats)
+        else:
+            self.open_alignments(mappings, threads)
+            for vcfFile in vcfFiles:
+                self.add_replacements(*self.integrate_variants(vcfFile))
+            self.mappings.close()
+        self.varTrack.close()
 
-        for sequence in self.sequenceDict:
-            if sequence not in self.outTracker:
-                self.varIntegration.write(self.sequenceDict[sequence]\
-                                          .get_fasta_string())
+        #the scaffolds are output in reference order on close
+        self.varIntegration.close()
+        #the kept pieces of the reference let the remap stage lift over
+        #alignments instead of mapping all reads again
+        self.varIntegration.write_piece_map(os.path.join(outPrefix, \
+                                                         'pieceMap.tsv'))
         for i in self.statCounter:
             print("{}\t{}".format(i,self.statCounter[i]), file=sys.stderr)
     
-    def integrate_variants(self, vcfFile):
+    def add_replacements(self, replacements, stats):
+        '''
+        hand the variants integrated from a vcf file over to the output
+        '''
+        
+        for identifier, scaffoldReplacements in replacements.items():
+            self.varIntegration.add_replacements(identifier, \
+                                                 scaffoldReplacements)
+            self.outTracker.add(identifier)
+        self.statCounter+=stats
+    
+    def integrate_variants(self, vcfFile, varTrack=None):
         '''
-        main method to integrate variants into the sequence
+        main method to integrate variants into the sequence. Returns the
+        (start, end, variant) replacements per scaffold and the stats, the
+        variants are written to the VarTrackWriter varTrack, the one of
+        the varTrack by default
         '''
         
-        sample=         None
         identifier=     None
-        modSequence=    ''
-        refSliceStart=  0
-        refSliceStop=   0
-        hetRef=         re.compile('0[/\|]\d+')
-        integratedSNV=  0
-        integratedIndel=0
+        edits=          None
         nonCovered=     0
-        filtered=       0
-        outputScaff=    set()
+        replacements=   {}
+        if varTrack is None:
+            varTrack=   self.varTrack
+        #variants of the current scaffold waiting for their coverage
+        pending=        []
         
-        #get filter intstances:
-        SNVFilterPass=SNVFilter()
-        IndelFilterPass=IndelFilter()
+        #load the calls as columns and filter them all at once
+        Calls=VariantColumns(vcfFile)
+        considered, snvPass, indelPass=filter_masks(Calls, self.minSNVqual, \
+                                                    self.minIndelQual)
+        passing=snvPass | indelPass
+        integratedSNV=  int(np.count_nonzero(snvPass))
+        integratedIndel=int(np.count_nonzero(indelPass))
+        #skip variants that don't pass the filter
+        filtered=       int(np.count_nonzero(considered & ~passing))
+        missingQD=      np.count_nonzero(considered & np.isnan(Calls.qd) & \
+                            (((Calls.kind==SNP) & \
+                              (Calls.qual >= self.minSNVqual)) | \
+                             ((Calls.kind==INDEL) & \
+                              (Calls.qual >= self.minIndelQual))))
+        if missingQD:
+            logging.warning('Missing QD field in {} calls!'.format(missingQD))
         
-        #open vcf iterator
-        vcf_reader = vcf.Reader(open(vcfFile, 'r'))
-        for Record in vcf_reader:
-            #get sample name in first iteration, there's only one
-            if sample is None:
-                call=Record.samples
-                for entry in call:
-                    sample=entry.sample
-                    
+        for i in np.flatnonzero(passing).tolist():
             #check if we're on a new scaffold
-            if Record.CHROM != identifier:
-                #make sure it's not the first one
-                if modSequence:
-                    modSequence+=self.sequenceDict[identifier].\
-                                sequence[refSliceStart:]
-                    Seq=DNASequence(identifier, modSequence)
-                    self.varIntegration.write(Seq.get_fasta_string())
-                    modSequence=''
-                    refSliceStart=  0
-                    refSliceStop=   0
-                    outputScaff.add(identifier)
-                identifier=Record.CHROM
-                    
-            #get the current genotype
-            genotype=Record.genotype(sample)['GT']
-
-            ###filtering
-            
-            #filter out heterozygous calls with reference variants
-            if  re.match(hetRef, genotype):
-                continue
-            #FILTER EXPRESSIONS FOR SNV
-            if Record.is_snp and SNVFilterPass(Record, self.minSNVqual):
-                    integratedSNV+=1
-            #FILTER EXPRESSION FOR INDELS
-            elif Record.is_indel and IndelFilterPass(Record, self.minIndelQual):
-                    integratedIndel+=1
-            #skip variants that don't pass the filter
-            else:
-                filtered+=1
-                continue
+            chrom=Calls.chroms[Calls.chrom[i]]
+            if chrom != identifier:
+                edits=None
+                nonCovered+=self.track_variants(identifier, pending, \
+                                                varTrack)
+                pending=[]
+                identifier=chrom
             
             ###integrate variant to seq
+            start=int(Calls.start[i])
+            end=start+int(Calls.refLength[i])
+            variant=Calls.allele(i)
+            if variant is None:
+                logging.critical('Missing allelic depths for the call at '\
+                                 '{}:{}'.format(chrom, start+1))
+                sys.exit(1)
             
-            # check if were dealing with a haploid sample
-            # (hack-ishly) and just take the alt if so
-            if len(genotype)==1:
-                variant=Record.ALT[0].sequence
-            #if it is homozygous alt, just integrate alt:
-            elif len(Record.ALT) == 1:
-                variant=Record.ALT[0].sequence
-            else:
-                #mayority rule pick from AD tag (allelic depth
-                allelicDepths=Record.genotype(sample)['AD']
-                maxDepth=allelicDepths.index(max(allelicDepths))
-                maxDepth=maxDepth-1 #to index the Record ALT list
-                #print(maxDepth,Record.ALT)
-                variant=Record.ALT[maxDepth].sequence
-                
-            #get coverage for the intervall
-            coverage=get_perfect_coverage(self.mappings, Record.CHROM,
-                             Record.start, Record.end)
-                
-            if coverage==0:
-                nonCovered+=1
-                
-            #get sequence from last point of integration up to current one
-            refSliceStop=Record.start
-            modSequence+=self.sequenceDict[Record.CHROM].\
-                        sequence[refSliceStart:refSliceStop]
+            #plug in variant, the edits keep the reference sequence
+            #from the last point of integration up to the current one
+            if edits is None:
+                edits=PieceTable(self.sequenceDict[chrom].sequence)
             #keep track of the new coordinates of variant insertion
-            varInsStart=len(modSequence)-1 #0based index
+            varInsStart=edits.replace(start, end, \
+                                      variant.encode())-1 #0based index
+            replacements.setdefault(identifier, []).append((start, \
+                                    end, variant.encode()))
             #get rid of splip on first base of chromosome
             if varInsStart<0:
                 varInsStart=0
             varInsEnd=varInsStart+len(variant)
-            #plug in variant
-            modSequence+=variant
-            #set new start
-            refSliceStart=Record.end
-            self.varTrack.write('{}\t{}\t{}\t{}\t{}\t{}\n'\
-                                        .format(Record.CHROM, varInsStart,\
-                                                varInsEnd, variant,\
-                                                Record.REF, coverage))
+            pending.append((start, end, varInsStart, varInsEnd,\
+                            variant, Calls.ref(i)))
             
-        #get sequence from last var untill end of sequence
-        #try-except to catch exception that occurs if no variants were called
-        try:
-            modSequence+=self.sequenceDict[Record.CHROM].\
-                        sequence[refSliceStart:]
-        except UnboundLocalError:
+        nonCovered+=self.track_variants(identifier, pending, varTrack)
+        #the scaffold of the last call is output even if none of its
+        #variants was integrated
+        if len(Calls) and Calls.chroms[Calls.chrom[-1]] != identifier:
+            identifier=Calls.chroms[Calls.chrom[-1]]
+            edits=None
+        if identifier is None:
             logging.warning('Looks like no variants have been called!')
-
-        #output last scaffold:
-        if modSequence:
-            Seq=DNASequence(identifier, modSequence)
-            self.varIntegration.write(Seq.get_fasta_string())
-            outputScaff.add(identifier)
+        elif edits is None:
+            edits=PieceTable(self.sequenceDict[identifier].sequence)
+            replacements.setdefault(identifier, [])
 
         stats=Counter()
         
@@ -235,9 +335,80 @@ class IntegrateTrackVariants(object):
         stats["INTEGRATED INDELS"]=integratedIndel
         stats["UNCOVERED VARS"]=nonCovered
         stats["FILTERED VARS"]=filtered
-        stats["ASSEMBLY LENGTH"]=len(modSequence)
+        stats["ASSEMBLY LENGTH"]=len(edits) if edits is not None else 0
+        
+        return replacements, stats
+    
+    def track_variants(self, identifier, variants, varTrack):
+        '''
+        write the integrated variants of a scaffold to the variant track,
+        along with the perfect coverage of the intervalls they replaced.
+        Returns the number of uncovered variants
+        '''
+        
+        coverages=self.perfect_coverages(identifier, \
+                                         [(start, end) for start, end, \
+                                          *_ in variants])
+        for (start, end, varInsStart, varInsEnd, variant, ref), coverage \
+            in zip(variants, coverages):
+            varTrack.add(identifier, varInsStart, varInsEnd, variant, ref, \
+                         coverage)
+        return coverages.count(0)
+    
+    def open_alignments(self, mappings, threads):
+        '''
+        open the alignment handle of this process
+        '''
         
-        return outputScaff, stats
+        self.mappings=pysam.AlignmentFile(mappings, 'rb', threads=threads)
+        if not self.coverageTrack:
+            self.perfect_coverages=partial(get_perfect_coverages, \
+                                           self.mappings)
+
+def filter_masks(Calls, minSNVqual, minIndelQual):
+    '''
+    the masks of the VariantColumns considered at all, and of the SNVs and
+    indels passing the filters
+    '''
+    
+    #get filter intstances:
+    SNVFilterPass=SNVFilter()
+    IndelFilterPass=IndelFilter()
+    
+    ###filtering
+    
+    #filter out heterozygous calls with reference variants
+    considered=~Calls.hetRef
+    #FILTER EXPRESSIONS FOR SNV
+    snvPass=considered & (Calls.kind==SNP) & \
+            SNVFilterPass.mask(Calls, minSNVqual)
+    #FILTER EXPRESSION FOR INDELS
+    indelPass=considered & (Calls.kind==INDEL) & \
+              IndelFilterPass.mask(Calls, minIndelQual)
+    return considered, snvPass, indelPass
+
+def init_worker(integration, mappings, threads):
+    '''
+    set up the integration of a worker process with its own alignments
+    '''
+    
+    global workerIntegration
+    workerIntegration=integration
+    workerIntegration.open_alignments(mappings, threads)
+
+def integrate_chunk(chunk):
+    '''
+    integrate the n-th chunk vcf in a worker process, writing its variants
+    to a varTrack fragment. Returns the fragment, replacements and stats
+    '''
+    
+    n, vcfFile=chunk
+    fragment=os.path.join(workerIntegration.outPrefix, \
+                          'varTrack.{}'.format(n))
+    varTrack=VarTrackWriter(fragment)
+    replacements, stats=workerIntegration.integrate_variants(vcfFile, varTrack)
+    varTrack.close()
+    return fragment, replacements, stats
 
     
 if __name__ == '__main__':
@@ -253,9 +424,21 @@ if __name__ == '__main__':
     parser.add_argument('outPrefix', type=str)
     parser.add_argument('minSNVqual', type=int)
     parser.add_argument('minIndelQual', type=int)
+    parser.add_argument('-lazy', action='store_true', \
+                        help='fetch scaffolds on demand through the .fai '\
+                        'index of the reference instead of loading it')
+    parser.add_argument('-threads', type=int, default=1, \
+                        help='threads decompressing the alignments')
+    parser.add_argument('-coverageTrack', action='store_true', \
+                        help='look up perfect coverage in the coverage track '\
+                        'of the alignments, built if needed')
+    parser.add_argument('-processes', type=int, default=1, \
+                        help='processes integrating the vcf files in parallel')
     parser.add_argument('-v', '--verbosity', type=str, \
                         choices=['info','WARNING','ERROR', 'DEBUG'], default='info')
     args=parser.parse_args()
     logging.basicConfig( stream=sys.stderr, format=logFormat, level=args.verbosity)
     i=IntegrateTrackVariants(args.reference, args.variants, args.alignments,\
-                             args.outPrefix, args.minSNVqual, args.minIndelQual)
\ No newline at end of file
+                             args.outPrefix, args.minSNVqual, args.minIndelQual,\
+                             args.lazy, args.threads, args.coverageTrack, \
+                             args.processes)
\ No newline at end of file
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+'''
+Lift alignments over to the reference with integrated variants. The piece
+map written by the variant integration lists the pieces of the old
+reference kept in the new one. Alignments lying well inside a kept piece
+(soft clipped bases included) are shifted to the new coordinates, all other
+reads, and their mates, are written to an interleaved fastq to be mapped
+again, along with the read groups for the header of the new alignments.
+'''
+
+import argparse
+import sys
+import logging
+from bisect import bisect_right
+import pysam
+from ECUtils import load_fai
+
+COMPLEMENT = str.maketrans('ACGTNacgtn', 'TGCANtgcan')
+
+
+class PieceMap(object):
+    '''
+    The kept pieces of the scaffolds of a pieceMap.tsv. Scaffolds that are
+    not listed are kept as a whole. lengths maps scaffolds to their old and
+    new lengths, to tell the scaffold ends from edits. Without them, the
+    last piece of a scaffold is taken to end at an edit
+    '''
+
+    def __init__(self, path, margin=5, lengths=None):
+        self.margin = margin
+        #starts, ends and shifts of the pieces per scaffold
+        self.pieces = {}
+        #scaffolds whose last piece reaches their unedited end
+        self.tails = set()
+        with open(path) as pieceMap:
+            for line in pieceMap:
+                if line.startswith('#'):
+                    continue
+                identifier, start, end, newStart = line.rstrip('\n').split('\t')
+                if identifier not in self.pieces:
+                    self.pieces[identifier] = ([], [], [])
+                starts, ends, shifts = self.pieces[identifier]
+                start, end, newStart = int(start), int(end), int(newStart)
+                #bases taken over a second time, after an edit moving back,
+                #stay with their first piece
+                if ends and start < ends[-1]:
+                    continue
+                starts.append(start)
+                ends.append(end)
+                shifts.append(newStart-start)
+        for identifier, (starts, ends, shifts) in self.pieces.items():
+            if lengths is None or identifier not in lengths:
+                continue
+            length, newLength = lengths[identifier]
+            if ends[-1] == length and ends[-1]+shifts[-1] == newLength:
+                self.tails.add(identifier)
+
+    def piece(self, identifier, position):
+        '''
+        the index of the piece containing a position, None if it is edited
+        '''
+        starts, ends, shifts = self.pieces[identifier]
+        i = bisect_right(starts, position)-1
+        if i < 0 or position >= ends[i]:
+            return None
+        return i
+
+    def shift(self, identifier, start, end):
+        '''
+        the shift of the intervall [start, end) if it lies within a kept
+        piece at least margin bases away from its edited ends, else None.
+        The ends of a scaffold are no edits, so there is no margin to them
+        '''
+        if identifier not in self.pieces:
+            return 0
+        starts, ends, shifts = self.pieces[identifier]
+        i = self.piece(identifier, start)
+        if i is None:
+            return None
+        #a piece starting at 0 without a shift has no edit before it
+        if (starts[i] > 0 or shifts[i] != 0) and \
+           start-self.margin < starts[i]:
+            return None
+        if (i < len(ends)-1 or identifier not in self.tails) and \
+           end+self.margin > ends[i]:
+            return None
+        return shifts[i]
+
+    def lift(self, identifier, position):
+        '''
+        the position in the new reference, None if it has been edited
+        '''
+        if identifier not in self.pieces:
+            return position
+        i = self.piece(identifier, position)
+        if i is None:
+            return None
+        return position+self.pieces[identifier][2][i]
+
+
+def clipped_span(read):
+    '''
+    the reference intervall of a read with its soft clipped bases
+    '''
+    start = read.reference_start
+    end = read.reference_end
+    cigar = read.cigartuples
+    if cigar[0][0] == 4:
+        start -= cigar[0][1]
+    if cigar[-1][0] == 4:
+        end += cigar[-1][1]
+    return max(0, start), end
+
+def read_shift(Pieces, alignments, read):
+    '''
+    the shift of a mapped read, None if it has to be mapped again
+    '''
+    if read.is_unmapped:
+        return None
+    return Pieces.shift(alignments.get_reference_name(read.reference_id), \
+                        *clipped_span(read))
+
+def lift_hits(Pieces, hits):
+    '''
+    lift the hits of an SA or XA tag, None if one of them has been edited
+    '''
+    lifted = []
+    for hit in hits.rstrip(';').split(';'):
+        fields = hit.split(',')
+        #XA positions carry the strand as sign
+        sign = fields[1][0] if fields[1][0] in '+-' else ''
+        position = Pieces.lift(fields[0], abs(int(fields[1]))-1)
+        if position is None:
+            return None
+        fields[1] = '{}{}'.format(sign, position+1)
+        lifted.append(','.join(fields))
+    return ';'.join(lifted)+';'
+
+def fastq_record(read):
+    '''
+    the read as sequenced, as fastq record with its read group as comment
+    so bwa mem -C keeps it
+    '''
+    sequence = read.query_sequence
+    qualities = 'I'*len(sequence)
+    if read.query_qualities is not None:
+        qualities = pysam.qualities_to_qualitystring(read.query_qualities)
+    if read.is_reverse:
+        sequence = sequence.translate(COMPLEMENT)[::-1]
+        qualities = qualities[::-1]
+    comment = ''
+    if read.has_tag('RG'):
+        comment = '\tRG:Z:'+read.get_tag('RG')
+    return '@{}{}\n{}\n+\n{}\n'.format(read.query_name, comment, sequence, \
+                                       qualities)
+
+def liftover(pieceMap, bam, reference, outPrefix, margin=5, threads=1):
+    '''
+    write the alignments of a bam file that can be shifted to
+    outPrefix.lifted.bam, with the scaffold lengths of the new reference,
+    the reads to map again to outPrefix.realign.fq and their read groups
+    to outPrefix.rg.sam
+    '''
+
+    newLengths = {identifier: entry[0] for identifier, entry \
+                  in load_fai(reference).items()}
+    with pysam.AlignmentFile(bam, 'rb') as alignments:
+        lengths = {identifier: (length, newLengths.get(identifier)) \
+                   for identifier, length in zip(alignments.references, \
+                                                 alignments.lengths)}
+        #the realigned reads keep their read groups as fastq comments,
+        #which need the @RG lines in the header
+        with open(outPrefix+'.rg.sam', 'w') as readGroups:
+            for line in str(alignments.header).splitlines():
+                if line.startswith('@RG'):
+                    print(line, file=readGroups)
+    Pieces = PieceMap(pieceMap, margin, lengths)
+
+    #reads with any alignment that can't be shifted are mapped again, along
+    #with their mates
+    realign = set()
+    with pysam.AlignmentFile(bam, 'rb', threads=threads) as alignments:
+        for read in alignments.fetch(until_eof=True):
+            if read_shift(Pieces, alignments, read) is None:
+                realign.add(read.query_name)
+    logging.info('{} reads touch edited sequence'.format(len(realign)))
+
+    lifted = 0
+    with pysam.AlignmentFile(bam, 'rb', threads=threads) as alignments:
+        header = alignments.header.to_dict()
+        for sequence in header.get('SQ', []):
+            sequence['LN'] = newLengths[sequence['SN']]
+            sequence.pop('M5', None)
+            sequence.pop('UR', None)
+        out = pysam.AlignmentFile(outPrefix+'.lifted.bam', 'wb', \
+                                  header=header, threads=threads)
+        fastq = open(outPrefix+'.realign.fq', 'w')
+        #first mates waiting for the second ones, for interleaved output
+        mates = {}
+        for read in alignments.fetch(until_eof=True):
+            if read.query_name in realign:
+                if read.is_secondary or read.is_supplementary:
+                    continue
+                if not read.is_paired:
+                    fastq.write(fastq_record(read))
+                elif read.query_name in mates:
+                    first, second = mates.pop(read.query_name), \
+                                    fastq_record(read)
+                    if read.is_read1:
+                        first, second = second, first
+                    fastq.write(first+second)
+                else:
+                    mates[read.query_name] = fastq_record(read)
+                continue
+            shift = read_shift(Pieces, alignments, read)
+            #the mate is lifted as well, otherwise the pair was realigned
+            if read.is_paired and not read.mate_is_unmapped:
+                mateShift = Pieces.lift(alignments.get_reference_name(\
+                                read.next_reference_id), \
+                                read.next_reference_start)-\
+                            read.next_reference_start
+                read.next_reference_start += mateShift
+                if read.template_length:
+                    read.template_length += mateShift-shift
+            read.reference_start += shift
+            for tag in ('SA', 'XA'):
+                if read.has_tag(tag):
+                    hits = lift_hits(Pieces, read.get_tag(tag))
+                    #alternative hits on edited sequence are dropped
+                    read.set_tag(tag, hits)
+            out.write(read)
+            lifted += 1
+        #mates missing from the bam are mapped as single reads
+        for record in mates.values():
+            fastq.write(record)
+        fastq.close()
+        out.close()
+    logging.info('Lifted over {} alignments'.format(lifted))
+
+
+if __name__ == '__main__':
+
+    logFormat = "%(asctime)s [%(levelname)s] %(message)s"
+    logging.basicConfig(stream=sys.stderr, format=logFormat, level='INFO')
+
+    #parse arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('pieceMap', type=str, help='pieceMap.tsv of the '\
+                        'variant integration')
+    parser.add_argument('alignments', type=str, help='coordinate sorted bam '\
+                        'file aligned to the old reference')
+    parser.add_argument('reference', type=str, help='the new reference')
+    parser.add_argument('outPrefix', type=str)
+    parser.add_argument('-margin', type=int, default=5, \
+                        help='minimum distance of lifted alignments to '\
+                        'edited bases')
+    parser.add_argument('-threads', type=int, default=1, \
+                        help='threads (de)compressing the alignments')
+    args=parser.parse_args()
+
+    liftover(args.pieceMap, args.alignments, args.reference, args.outPrefix, \
+             args.margin, args.threads)
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+import argparse
+import sys
+import logging
+from ECUtils import stream_fastq_range, interleave_fastq_ranges
+
+if __name__ == '__main__':
+    
+    logFormat = "%(asctime)s [%(levelname)s] %(message)s"
+    logging.basicConfig( stream=sys.stderr, format=logFormat)
+    
+    #parse arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('nReads', type=int)
+    parser.add_argument('pair1', type=str)
+    parser.add_argument('start1', type=int)
+    parser.add_argument('end1', type=int)
+    parser.add_argument('pair2', type=str, nargs='?', default=None)
+    parser.add_argument('start2', type=int, nargs='?', default=None)
+    parser.add_argument('end2', type=int, nargs='?', default=None)
+    args=parser.parse_args()
+    
+    if args.pair2 is None:
+        stream_fastq_range(args.pair1, args.start1, args.end1, sys.stdout.buffer)
+    else:
+        interleave_fastq_ranges(args.pair1, args.start1, args.pair2, \
+                                args.start2, args.nReads, sys.stdout.buffer)
+    sys.stdout.buffer.flush()
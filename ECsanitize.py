@@ -6,7 +6,16 @@ import re
 import logging
 import argparse
 import pysam
+import numpy as np
+from functools import partial
+from multiprocessing import get_context
 from ECUtils import *
+from ECvarTrack import VarTrack, VarTrackWriter, read_var_track
+
+#perfect coverage lookup and variant track of a worker process, set up by
+#init_worker
+workerCoverages=None
+workerTrack=None
 
 class SanitizeVariants(object):
     '''
@@ -14,35 +23,61 @@ class SanitizeVariants(object):
     corrections based on read depth counts of near perfect read matches
     '''
     
-    def __init__(self, bam, reference, varTrack, outfilePrefix):
+    def __init__(self, bam, reference, varTrack, outfilePrefix, lazy=False,\
+                 threads=1, coverageTrack=False, processes=1, windowSize=1<<14):
 
         input_length=0        
         self.outputScaffolds=set()
         self.outfilePrefix=outfilePrefix
         self.varTrack=varTrack
+        self.bam=bam
+        self.threads=threads
+        self.trackPrefix=None
+        self.processes=processes
+        self.windowSize=windowSize
+        self.nVars=0
 
-        #parse fasta into dict of seqrecords:
-        self.sequences=dict()        
-        logging.info('loading in reference')
-        for Sequence in load_fasta(reference):
-            self.sequences[Sequence.identifier]=Sequence
-            input_length+=len(Sequence.sequence)
+        #parse fasta into dict of seqrecords, or fetch them on demand
+        #in lazy mode:
+        if lazy:
+            logging.info('opening indexed reference')
+            self.sequences=IndexedFasta(reference)
+            for identifier in self.sequences:
+                input_length+=self.sequences.length(identifier)
+        else:
+            self.sequences=dict()
+            logging.info('loading in reference')
+            for Sequence in load_fasta(reference):
+                self.sequences[Sequence.identifier]=Sequence
+                input_length+=len(Sequence.sequence)
+        
+        self.varSanitiation=CorrectedFasta(reference, self.sequences, \
+            os.path.join(outfilePrefix, 'reference.sanitizedVariants.fa'))
         
-        self.varSanitiation=open(os.path.join(outfilePrefix, 'reference.sanitizedVariants.fa'),'w')
+        #a varTrack.tsv is converted to a binary variant track first
+        if varTrack.endswith('.tsv'):
+            self.varTrack=os.path.join(outfilePrefix, 'varTrack.imported')
+            Writer=VarTrackWriter(self.varTrack)
+            for row in read_var_track(varTrack):
+                Writer.add(*row)
+            Writer.close()
+        self.Track=VarTrack(self.varTrack)
         
         #check if we've got any variants to integrate, if so run it
-        if os.path.getsize(self.varTrack) > 0:
-            self.varTrack=open(varTrack,'r')
-            self.Alignments=pysam.AlignmentFile(bam, 'rb')
+        if len(self.Track) > 0:
+            #look up perfect coverage in the persisted track of the bam
+            #or in the bam itself, opened by the process using it
+            if coverageTrack:
+                from ECcoverageTrack import load_coverage_track
+                Track=load_coverage_track(bam, threads=threads)
+                self.trackPrefix=Track.prefix
+                self.perfect_coverages=Track.perfect_coverages
             self.sanitize_variants()
-            self.Alignments.close()
-            self.varTrack.close()
+        else:
+            self.write_changed_regions({})
         
-        #output scaffolds on which no corrections have been made
-        for sequence in self.sequences:
-            if sequence not in self.outputScaffolds:
-                self.varSanitiation.write(self.sequences[sequence]\
-                                          .get_fasta_string())
+        #output scaffolds on which no corrections have been made, or patch
+        #a copy of the reference if no correction changed a length
         self.varSanitiation.close()
         
     def sanitize_variants(self):
@@ -50,57 +85,134 @@ class SanitizeVariants(object):
         main method to sanitize variants 
         '''
         
-        modSequence         =''
-        currentIdentifier   =''
-        refSliceStart       =0
-        refSliceStop        =0
-        nVars               =0
         rejectedVars        =0
-        input_length=0
+        #rejected variants to revert per scaffold, in varTrack order
+        replacements        ={}
         
-        for entry in self.varTrack:
-            nVars+=1
-            identifier, start, end, variant, \
-            subVariant, coverage=entry.split('\t')
-            start=int(start)
-            end=int(end)
-            coverage=int(coverage)
-
-            #check if we're on a new scaffold
-            if identifier != currentIdentifier:
-                #make sure it's not the first one
-                if modSequence:
-                    #append remaining sequence
-                    modSequence+=self.sequences[currentIdentifier].\
-                                    sequence[refSliceStart:]
-                    Seq=DNASequence(currentIdentifier, modSequence)                    
-                    self.varSanitiation.write(Seq.get_fasta_string())
-                    self.outputScaffolds.add(Seq.identifier)
-                    refSliceStart=0
-                    refSliceStop=0
-                    modSequence=''
-                currentIdentifier=identifier
-            
-            newCoverage=get_perfect_coverage(self.Alignments, identifier,
-                start, end)
-            if newCoverage < coverage or (coverage==0 and newCoverage==0):
-                refSliceStop=start
-                modSequence+=self.sequences[identifier].\
-                        sequence[refSliceStart:refSliceStop]
-                refSliceStart=end
-                #reinsert previous allel
-                modSequence+=subVariant
-                
-                rejectedVars+=1
+        #windows of variants are checked in worker processes with their
+        #own alignment handles, or one after the other. A threaded htslib
+        #handle can't be closed in a forked child, so the parent doesn't
+        #open one before forking
+        if self.processes > 1:
+            logging.info('sanitizing in {} processes'.format(self.processes))
+            workerThreads=max(1, self.threads//self.processes)
+            with get_context('fork').Pool(self.processes, \
+                 initializer=init_worker, initargs=(self.bam, \
+                 self.trackPrefix, self.varTrack, workerThreads)) as pool:
+                for identifier, rejected in pool.imap(reject_window, \
+                                                      self.windows()):
+                    replacements.setdefault(identifier, []).extend(rejected)
+        else:
+            self.Alignments=pysam.AlignmentFile(self.bam, 'rb', \
+                                                threads=self.threads)
+            if self.trackPrefix is None:
+                self.perfect_coverages=partial(get_perfect_coverages, \
+                                               self.Alignments)
+            for identifier, first, last in self.windows():
+                rejected=reject_variants(self.perfect_coverages, identifier, \
+                                         window_variants(self.Track, \
+                                                         identifier, first, \
+                                                         last))
+                replacements.setdefault(identifier, []).extend(rejected)
+            self.Alignments.close()
         
-        #get last entry:
-        modSequence+=self.sequences[identifier].\
-                        sequence[refSliceStart:]
-        Seq=DNASequence(currentIdentifier, modSequence)
-        self.varSanitiation.write(Seq.get_fasta_string())
-        self.outputScaffolds.add(Seq.identifier)
+        #the scaffolds are written in reference order on close
+        for identifier, rejected in replacements.items():
+            self.varSanitiation.add_replacements(identifier, rejected)
+            self.outputScaffolds.add(identifier)
+            rejectedVars+=len(rejected)
         print('REJECTED {}'.format(rejectedVars))
-        print(nVars)
+        print(self.nVars)
+        self.write_changed_regions(replacements)
+    
+    def write_changed_regions(self, replacements):
+        '''
+        write the intervalls of the accepted variants, in coordinates of the
+        sanitized reference, to changedRegions.tsv. The next iteration only
+        calls variants in and around these regions
+        '''
+        
+        changedRegions=os.path.join(self.outfilePrefix, 'changedRegions.tsv')
+        with open(changedRegions, 'w') as out:
+            print('#scaffold\tstart\tend', file=out)
+            for identifier in self.Track.scaffolds:
+                records=self.Track.scaffold(identifier)
+                rejected=set((start, end) for start, end, _ in \
+                             replacements.get(identifier, []))
+                reverted=np.array([(start, end) in rejected for start, end \
+                                   in zip(records['start'].tolist(), \
+                                          records['end'].tolist())], \
+                                  dtype=bool)
+                #reverted variants shift all following ones by the length
+                #difference of the previous allel
+                shifts=np.where(reverted, records['refLength']-\
+                                (records['end']-records['start']), 0)
+                offsets=np.cumsum(shifts)-shifts
+                for start, end in zip((records['start']+offsets)[~reverted]\
+                                      .tolist(), \
+                                      (records['end']+offsets)[~reverted]\
+                                      .tolist()):
+                    print('{}\t{}\t{}'.format(identifier, start, end), \
+                          file=out)
+    
+    def windows(self):
+        '''
+        yields the variants of the variant track per scaffold, in windows
+        of at most windowSize variants, as scaffold, first and last variant
+        '''
+        
+        self.nVars=len(self.Track)
+        for identifier in self.Track.scaffolds:
+            nVariants=len(self.Track.scaffold(identifier))
+            for first in range(0, nVariants, self.windowSize):
+                yield identifier, first, min(nVariants, first+self.windowSize)
+
+def window_variants(Track, identifier, first, last):
+    '''
+    the start, end, previous allel and coverage of the variants in a window
+    of the VarTrack
+    '''
+    
+    return [(start, end, subVariant, coverage) for _, start, end, variant, \
+            subVariant, coverage in \
+            Track.rows(Track.scaffold(identifier)[first:last])]
+
+def reject_variants(perfect_coverages, identifier, variants):
+    '''
+    returns the variants of a scaffold that lost perfect coverage, as
+    (start, end, previous allel) replacements reverting them
+    '''
+    
+    rejected=[]
+    newCoverages=perfect_coverages(identifier, [(start, end) for start, end, \
+                                                *_ in variants])
+    for (start, end, subVariant, coverage), newCoverage in \
+        zip(variants, newCoverages):
+        if newCoverage < coverage or (coverage==0 and newCoverage==0):
+            #reinsert previous allel
+            rejected.append((start, end, subVariant.encode()))
+    return rejected
+
+def init_worker(bam, trackPrefix, varTrack, threads):
+    '''
+    open the variant track and the alignments, or their coverage track,
+    once per worker process
+    '''
+    
+    global workerCoverages, workerTrack
+    workerTrack=VarTrack(varTrack)
+    if trackPrefix is not None:
+        from ECcoverageTrack import CoverageTrack
+        workerCoverages=CoverageTrack(trackPrefix).perfect_coverages
+    else:
+        workerCoverages=partial(get_perfect_coverages, \
+                                pysam.AlignmentFile(bam, 'rb', threads=threads))
+
+def reject_window(window):
+    identifier, first, last=window
+    return identifier, reject_variants(workerCoverages, identifier, \
+                                       window_variants(workerTrack, \
+                                                       identifier, first, last))
         
 if __name__ == '__main__':
     
@@ -111,11 +223,27 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('reference', type=str)
     parser.add_argument('alignments', type=str)
-    parser.add_argument('vartrack', type=str)
+    parser.add_argument('vartrack', type=str, help='prefix of the binary '\
+                        'variant track, or a varTrack.tsv')
     parser.add_argument('outfilePrefix', type=str)
+    parser.add_argument('-lazy', action='store_true', \
+                        help='fetch scaffolds on demand through the .fai '\
+                        'index of the reference instead of loading it')
+    parser.add_argument('-threads', type=int, default=1, \
+                        help='threads decompressing the alignments')
+    parser.add_argument('-coverageTrack', action='store_true', \
+                        help='look up perfect coverage in the coverage track '\
+                        'of the alignments, built if needed')
+    parser.add_argument('-processes', type=int, default=1, \
+                        help='processes checking windows of variants in '\
+                        'parallel')
+    parser.add_argument('-windowSize', type=int, default=1<<14, \
+                        help='maximum number of variants per window')
     parser.add_argument('-v', '--verbosity', type=str, \
                         choices=['info','WARNING','ERROR', 'DEBUG'], default='info')
     args=parser.parse_args()
     logging.basicConfig( stream=sys.stderr, format=logFormat, level=args.verbosity)
 
-    i=SanitizeVariants(args.alignments, args.reference, args.vartrack, args.outfilePrefix)
\ No newline at end of file
+    i=SanitizeVariants(args.alignments, args.reference, args.vartrack, args.outfilePrefix,\
+                       args.lazy, args.threads, args.coverageTrack, \
+                       args.processes, args.windowSize)
\ No newline at end of file
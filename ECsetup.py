@@ -4,29 +4,70 @@ import argparse
 import sys
 import os
 import re
+import errno
+import signal
 import logging
 import gzip
-from ECUtils import load_fastq
+import mmap
+import struct
+import string
+import subprocess
+import threading
+import queue
+from array import array
+from hashlib import blake2b
+from multiprocessing import Pool
+from concurrent.futures import ProcessPoolExecutor
+from bisect import bisect_left
+from itertools import accumulate, chain
+from ECUtils import load_fastq_blocks, mate_name, count_fastq_records, index_fastq,\
+                    seek_fastq_record, count_fastq_bases, bgzf_compress, \
+                    gzip_compress, BGZF_EOF
+
+#size of the write buffer of each chunk file
+WRITE_BUFFER=1<<23
+#fixed key of the duplicate fingerprints, so they are the same in every run
+FINGERPRINT_KEY=b'raccoon.dedup'
 
 class Setup(object):
     '''
-    Setup class to chop input reads and create a reference dictionary
+    Setup class to chop the input reads of one library and check the
+    reference headers
     '''
     
     def __init__(self, reference, readFile1, readFile2, \
-                 basedir, nPairs, nChunks=None):
+                 basedir, nPairs=None, nChunks=None, virtual=False, \
+                 compression=None, processes=1, dedup=False, dedupMemory=4096,\
+                 balance='reads', stream=False):
         self.reference=reference
         self.readFile1=readFile1
         self.readFile2=readFile2
         self.nPairs=nPairs
         self.basedir=basedir
         self.nChunks=nChunks
+        self.virtual=virtual
+        self.compression=compression
+        self.processes=processes
+        self.pool=None
+        self.dedup=dedup
+        self.dedupMemory=dedupMemory
+        self.balance=balance
+        self.stream=stream
+        self.nBases=None
+        self.survivors=None
         
         if self.readFile2=="None":
             self.readFile2=None
         
-    def run(self):
-        self.check_fasta_header()
+    def run(self, checkReference=True):
+        if checkReference:
+            self.check_fasta_header()
+        if (self.dedup or self.stream) and not self.nChunks:
+            #deduplicated or streamed reads have to be written somewhere
+            self.nChunks=1
+        if self.stream:
+            self.chunk()
+            return
         if self.nChunks is None or self.nChunks==0:
             suffix=''
             if self.readFile1.endswith('gz')\
@@ -35,54 +76,881 @@ class Setup(object):
             simLinkP1=os.path.join(self.basedir, 'reads.p1.fq'+suffix)
             simLinkP2=os.path.join(self.basedir, 'reads.p2.fq'+suffix)
             os.symlink(self.readFile1, simLinkP1)
-            os.symlink(self.readFile2, simLinkP2)
+            if self.readFile2 is not None:
+                os.symlink(self.readFile2, simLinkP2)
+        elif self.virtual and not self.dedup and \
+             not self.readFile1.endswith(('gz', 'gzip')):
+            self.virtualChunks()
         else:
-            self.chunkReads(self.readFile1, 1)
+            if self.virtual:
+                logging.warning('Virtual chunks need uncompressed read files '\
+                                'and no deduplication, writing chunk files '\
+                                'instead')
+            if self.dedup and self.nChunks>1:
+                #the chunks are sized by the reads that are actually written
+                self.nPairs, self.nBases=self.count_survivors()
+            elif self.balance=='bases':
+                self.nPairs, self.nBases=self.count_reads(self.readFile1, True)
+                if self.readFile2 is not None:
+                    self.nBases+=self.count_reads(self.readFile2, True)[1]
+            elif self.nPairs is None:
+                self.nPairs=self.count_reads(self.readFile1)
+            if self.compression and self.processes>1:
+                with Pool(self.processes) as self.pool:
+                    self.chunk()
+                self.pool=None
+            else:
+                self.chunk()
+
+    def chunk(self):
+        '''
+        Chunk the read files for scattered mapping
+        '''
+        mates=['p1'] if self.readFile2 is None else ['p1', 'p2']
+        chunks=self.chunk_files(mates)
+        try:
             if self.readFile2 is not None:
-                self.chunkReads(self.readFile2, 2)
+                self.chunkPairedReads(self.readFile1, self.readFile2, chunks)
+            else:
+                self.chunkReads(self.readFile1, chunks)
+        except BaseException:
+            #don't leave mapping processes or pipes behind
+            chunks.abort()
+            raise
+        chunks.finish()
     
-    def check_fasta_header(self):
+    def open_chunk(self, chunkFileName):
+        '''
+        open a chunk file for writing, compressed if requested
+        '''
+        path=os.path.join(self.basedir, chunkFileName)
+        if self.compression:
+            return CompressedChunkWriter(path+'.gz', self.compression, \
+                                         self.pool, 2*self.processes)
+        return open(path, 'wb', buffering=WRITE_BUFFER)
+    
+    def virtualChunks(self, step=4096):
+        '''
+        Instead of copying the reads into chunk files, index the record
+        offsets of the read files and write a table of byte ranges
+        (chunks.tsv) that the mapping stage streams from the original files.
+        Chunk boundaries are found by reading forward from the closest
+        indexed record, so the chunks hold the same number of reads
+        '''
+        readFiles=[self.readFile1]
+        if self.readFile2 is not None:
+            readFiles.append(self.readFile2)
+        
+        indices=[]
+        for pair, readfile in enumerate(readFiles, 1):
+            nReads, offsets=self.fastq_index(readfile, pair, step)
+            indices.append((readfile, nReads, offsets, \
+                            os.path.getsize(readfile)))
+        
+        if len(indices)==2 and indices[0][1]!=indices[1][1]:
+            logging.critical("The read files {} and {} contain a different "\
+                             "number of reads!".format(self.readFile1, \
+                                                       self.readFile2))
+            sys.exit(1)
+        
+        nReads=indices[0][1]
+        readsPerChunk=-(-nReads//self.nChunks) or 1
+        logging.info('splitting read files into virtual chunks of {} reads'\
+                     .format(readsPerChunk))
+        
+        with open(os.path.join(self.basedir, 'chunks.tsv'), 'w') as chunks:
+            for first in range(0, nReads, readsPerChunk):
+                entry=['{}'.format(first), \
+                       '{}'.format(min(readsPerChunk, nReads-first))]
+                names=[]
+                for readfile, n, offsets, size in indices:
+                    with open(readfile, 'rb') as r:
+                        end=size
+                        if first+readsPerChunk<nReads:
+                            end=seek_fastq_record(r, offsets, step, \
+                                                  first+readsPerChunk)
+                        start=seek_fastq_record(r, offsets, step, first)
+                        names.append(mate_name(r.readline().decode()))
+                    entry+=[readfile, str(start), str(end)]
+                if len(set(names))!=1:
+                    logging.critical("Mates are out of sync in read {}: {}"\
+                                     .format(first, " and ".join(names)))
+                    sys.exit(1)
+                print('\t'.join(entry), file=chunks)
+
+    def fastq_index(self, readfile, pair, step):
+        '''
+        Returns the number of records of a read file and the offsets of
+        every step-th record. The index is kept in reads.p1.fqi (or .p2)
+        along with the step and the size of the read file, and is reused as
+        long as it is newer than the read file
+        '''
+        path=os.path.join(self.basedir, 'reads.p{}.fqi'.format(pair))
+        size=os.path.getsize(readfile)
+        if os.path.exists(path) and \
+           os.path.getmtime(path)>=os.path.getmtime(readfile):
+            header=array('Q')
+            offsets=array('Q')
+            with open(path, 'rb') as idx:
+                try:
+                    header.fromfile(idx, 3)
+                except EOFError:
+                    pass
+                if list(header)[::2]==[step, size]:
+                    logging.info('Using record offsets of {} from {}'\
+                                 .format(readfile, path))
+                    offsets.frombytes(idx.read())
+                    return header[1], offsets
+        logging.info('Indexing record offsets of {}'.format(readfile))
+        nReads, offsets=index_fastq(readfile, step)
+        with open(path, 'wb') as idx:
+            array('Q', [step, nReads, size]).tofile(idx)
+            offsets.tofile(idx)
+        return nReads, offsets
+    
+    def count_reads(self, readfile, bases=False):
+        '''
+        Count the records of a read file, and their bases if asked for. The
+        counts are cached in a sidecar file keyed by size and mtime of the
+        read file in the output directory. The input directory is never
+        written to, but a sidecar found next to the read file is used.
+        '''
+        stat=os.stat(readfile)
+        key=['{}'.format(stat.st_size), '{}'.format(stat.st_mtime_ns)]
+        outSidecar=os.path.join(self.basedir, \
+                                os.path.basename(readfile)+'.nreads')
+        for sidecar in [outSidecar, readfile+'.nreads']:
+            try:
+                with open(sidecar) as s:
+                    cached=s.read().rstrip('\n').split('\t')
+            except OSError:
+                continue
+            #the base count is only there if it was asked for before
+            if cached[:2]==key and len(cached)>=(4 if bases else 3):
+                logging.info('Using cached read count of {} from {}'\
+                             .format(cached[2], sidecar))
+                if bases:
+                    return int(cached[2]), int(cached[3])
+                return int(cached[2])
         
+        if bases:
+            logging.info('Counting reads and bases in {}'.format(readfile))
+            counts=count_fastq_bases(readfile)
+        else:
+            logging.info('Counting reads in {}'.format(readfile))
+            counts=(count_fastq_records(readfile),)
+        with open(outSidecar, 'w') as s:
+            s.write('\t'.join(key+[str(count) for count in counts])+'\n')
+        return counts if bases else counts[0]
+
+    def check_fasta_header(self):
+        '''
+        Make sure the reference headers only contain characters that all
+        downstream tools accept
+        '''
         p=re.compile('[^a-zA-Z0-9_.\-!?=+():#]')
-        with open(self.reference) as r:
-            for line in r:
-                if line.startswith('>'):
-                    line=line.rstrip()
-                    if re.search(p, line.lstrip('>')) is not None:
-                        logging.critical("The headers of the reference may "\
-                                         "only contain the follwing characters:"\
-                                         " a-z, A-Z, 0-9, _.!?=+()- . "\
-                                         "Make sure there is no whitespace!\n"\
-                                         "Conflicting header: {} ".format(line))
-                        sys.exit(1)
+        for header in self.reference_headers():
+            if re.search(p, header) is not None:
+                logging.critical("The headers of the reference may "\
+                                 "only contain the follwing characters:"\
+                                 " a-z, A-Z, 0-9, _.!?=+()- . "\
+                                 "Make sure there is no whitespace!\n"\
+                                 "Conflicting header: >{} ".format(header))
+                sys.exit(1)
+    
+    def reference_headers(self):
+        '''
+        Yield the headers of the reference without '>'. If an up to date .fai
+        exists, the sequence names are taken from it (note that it doesn't
+        know about anything following whitespace in a header). Otherwise the
+        reference is memory mapped and scanned from '>' to '>', so the
+        sequence lines are never touched by python
+        '''
+        fai=self.reference+'.fai'
+        if os.path.exists(fai) and \
+           os.path.getmtime(fai)>=os.path.getmtime(self.reference):
+            logging.info('Checking sequence names in {}'.format(fai))
+            with open(fai) as f:
+                for line in f:
+                    yield line.split('\t', 1)[0]
+            return
+        
+        if os.path.getsize(self.reference)==0:
+            return
+        with open(self.reference, 'rb') as r, \
+             mmap.mmap(r.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            position=m.find(b'>')
+            while position>=0:
+                end=m.find(b'\n', position)
+                if end<0:
+                    end=len(m)
+                #'>' is only allowed at the start of a line
+                if position==0 or m[position-1]==10:
+                    yield m[position+1:end].rstrip().decode()
+                position=m.find(b'>', end)
         
-    def chunkReads(self, readfile, pair):
+    def chunkReads(self, readfile, chunks):
         '''
         Method to divide the reads into equaly sized chunks
         for scattered mapping.
         '''
-        #I should be counting readpairs somwhere here
-        readsPerChunk=(self.nPairs//self.nChunks)+1
-        print('{} divided by {} is {}'.format(self.nPairs,self.nChunks, readsPerChunk))
-        logging.info('splitting read files into chunks of {} reads'.format(readsPerChunk))
-        
-        chunk=0
+        dedup=self.duplicate_filter(1)
+        #records are passed through as raw slices of the parsed blocks
+        for block in load_fastq_blocks(readfile):
+            start=0
+            while start<len(block):
+                stop=start+chunks.span([block], [start], len(block)-start)
+                if dedup is None:
+                    chunks.write([block.raw(start, stop)], stop-start, \
+                                 block.bases(start, stop))
+                else:
+                    for i, seq in enumerate(block.sequences(start, stop), start):
+                        raws=[block.raw(i, i+1)]
+                        if dedup.check(fingerprint(seq), raws):
+                            chunks.write(raws, 1, len(seq))
+                start=stop
+        self.write_survivors(dedup, chunks)
+
+    def chunkPairedReads(self, readfile1, readfile2, chunks):
+        '''
+        Method to divide both mates of a paired library into equaly sized
+        chunks in a single pass. Both files are read in lockstep, so chunk
+        boundaries always line up and mate names are checked on the way.
+        '''
         nReads=0
-        readTracker=0
-        chunkFile=None
-        prefix='p1' if pair==1 else 'p2'
-        for read in load_fastq(readfile):
-            if readTracker%readsPerChunk==0:
-                readTracker=0
-                if chunkFile:
-                    chunkFile.close()
-                chunkFileName='{}.{}.fq'.format(nReads, prefix)
-                chunkFile=open(os.path.join(self.basedir,chunkFileName), 'w')
-            chunkFile.write('\n'.join(read)+"\n")
+        dedup=self.duplicate_filter(2)
+        blocks1=load_fastq_blocks(readfile1)
+        blocks2=load_fastq_blocks(readfile2)
+        block1=block2=None
+        start1=start2=0
+        #the blocks of both files hold different numbers of records, so
+        #we advance through them in spans that fit into all of them
+        while True:
+            if block1 is None or start1==len(block1):
+                block1=next(blocks1, None)
+                start1=0
+            if block2 is None or start2==len(block2):
+                block2=next(blocks2, None)
+                start2=0
+            if block1 is None or block2 is None:
+                if block1 is not None or block2 is not None:
+                    logging.critical("The read files {} and {} contain a "\
+                                     "different number of reads!"\
+                                     .format(readfile1, readfile2))
+                    sys.exit(1)
+                break
+            span=chunks.span([block1, block2], [start1, start2], \
+                             min(len(block1)-start1, len(block2)-start2))
+            names1=block1.names(start1, start1+span)
+            names2=block2.names(start2, start2+span)
+            if names1!=names2:
+                mismatch=next(i for i in range(span) if names1[i]!=names2[i])
+                logging.critical("Mates are out of sync in read {}: {} and {}"\
+                                 .format(nReads+mismatch, \
+                                         names1[mismatch].decode(), \
+                                         names2[mismatch].decode()))
+                sys.exit(1)
+            if dedup is None:
+                chunks.write([block1.raw(start1, start1+span), \
+                              block2.raw(start2, start2+span)], span, \
+                             block1.bases(start1, start1+span)+\
+                             block2.bases(start2, start2+span))
+            else:
+                seqs=zip(block1.sequences(start1, start1+span), \
+                         block2.sequences(start2, start2+span))
+                for i, mates in enumerate(seqs):
+                    raws=[block1.raw(start1+i, start1+i+1), \
+                          block2.raw(start2+i, start2+i+1)]
+                    if dedup.check(fingerprint(*mates), raws):
+                        chunks.write(raws, 1, len(mates[0])+len(mates[1]))
+            nReads+=span
+            start1+=span
+            start2+=span
+        self.write_survivors(dedup, chunks)
+    
+    def chunk_files(self, mates):
+        '''
+        get the ChunkFiles for the mates, balanced by reads or bases, or
+        the StreamFiles feeding the mapping processes
+        '''
+        if self.stream:
+            with open(os.path.join(self.basedir, 'map.template')) as t:
+                template=string.Template(t.read())
+            logging.info('streaming reads into {} mapping processes'\
+                         .format(self.nChunks))
+            return StreamFiles(self, mates, template, self.nChunks)
+        if self.balance=='bases':
+            basesPerChunk=(self.nBases//self.nChunks)+1
+            logging.info('splitting reads into chunks of {} bases'\
+                         .format(basesPerChunk))
+            return ChunkFiles(self, mates, None, basesPerChunk)
+        readsPerChunk=(self.nPairs//self.nChunks)+1
+        logging.info('splitting reads into chunks of {} reads (pairs)'\
+                     .format(readsPerChunk))
+        return ChunkFiles(self, mates, readsPerChunk)
+    
+    def duplicate_filter(self, nMates):
+        '''
+        get a DuplicateFilter if reads are to be deduplicated
+        '''
+        if not self.dedup:
+            return None
+        return DuplicateFilter(os.path.join(self.basedir, 'dedup.tmp'), \
+                               nMates, self.dedupMemory)
+    
+    def count_survivors(self):
+        '''
+        Count the reads (pairs) and their bases left after deduplication.
+        The sequences are run through a DuplicateFilter of their own, which
+        keeps the same first occurrences as the one of the chunking
+        '''
+        if self.survivors is not None:
+            return self.survivors
+        readFiles=[self.readFile1]
+        if self.readFile2 is not None:
+            readFiles.append(self.readFile2)
+        logging.info('Counting deduplicated reads in {}'\
+                     .format(' and '.join(readFiles)))
+        dedup=self.duplicate_filter(len(readFiles))
+        sequences=[chain.from_iterable(block.sequences() for block \
+                                       in load_fastq_blocks(readfile)) \
+                   for readfile in readFiles]
+        nReads=nBases=0
+        for mates in zip(*sequences):
+            if dedup.check(fingerprint(*mates), mates):
+                nReads+=1
+                nBases+=sum(map(len, mates))
+        for mates in dedup.survivors():
             nReads+=1
-            readTracker+=1
-        chunkFile.close()
-                               
+            nBases+=sum(map(len, mates))
+        self.survivors=(nReads, nBases)
+        return self.survivors
+    
+    def write_survivors(self, dedup, chunks):
+        '''
+        write the reads a DuplicateFilter had to spill to disk
+        '''
+        if dedup is None:
+            return
+        for raws in dedup.survivors():
+            chunks.room()
+            chunks.write(raws, 1, sum(len(raw.split(b'\n', 2)[1]) \
+                                      for raw in raws))
+        logging.info('Removed {} duplicate reads (pairs) from {}'\
+                     .format(dedup.duplicates, self.basedir))
+
+
+class ChunkFiles(object):
+    '''
+    The chunk files of a library, one per mate. A new set of chunk files is
+    started once readsPerChunk reads or, if given, basesPerChunk bases have
+    been written. The reads and bases of every chunk are recorded in
+    chunks.manifest.tsv
+    '''
+    
+    def __init__(self, setup, mates, readsPerChunk, basesPerChunk=None):
+        self.setup=setup
+        self.mates=mates
+        self.readsPerChunk=readsPerChunk
+        self.basesPerChunk=basesPerChunk
+        self.nReads=0
+        self.inChunk=0
+        self.basesInChunk=0
+        self.files=[]
+        self.manifest=[]
+    
+    def room(self):
+        '''
+        return how many reads (or bases) still fit into the current chunk,
+        moving on to the next chunk if it is full
+        '''
+        if self.basesPerChunk is None:
+            full=self.inChunk>=self.readsPerChunk
+        else:
+            full=self.basesInChunk>=self.basesPerChunk
+        if not self.files or full:
+            self.close()
+            self.files=[self.setup.open_chunk('{}.{}.fq'.format(self.nReads,\
+                                                                mate))\
+                        for mate in self.mates]
+            self.manifest.append([self.nReads, 0, 0])
+            self.inChunk=0
+            self.basesInChunk=0
+        if self.basesPerChunk is None:
+            return self.readsPerChunk-self.inChunk
+        return self.basesPerChunk-self.basesInChunk
+    
+    def span(self, blocks, starts, maxSpan):
+        '''
+        return how many of the next maxSpan reads (pairs) of the blocks fit
+        into the current chunk. When balancing by bases, the read that
+        fills the chunk up is still taken
+        '''
+        room=self.room()
+        if self.basesPerChunk is None:
+            return min(maxSpan, room)
+        lengths=[block.lengths(start, start+maxSpan) \
+                 for block, start in zip(blocks, starts)]
+        cumulative=list(accumulate(map(sum, zip(*lengths))))
+        return min(maxSpan, bisect_left(cumulative, room)+1)
+    
+    def write(self, raws, nReads, nBases):
+        '''
+        write the raw records of nReads reads (pairs) with nBases bases, one
+        entry per mate. Callers make sure they fit into the current chunk
+        '''
+        for chunkFile, raw in zip(self.files, raws):
+            chunkFile.write(raw)
+        self.nReads+=nReads
+        self.inChunk+=nReads
+        self.basesInChunk+=nBases
+        self.manifest[-1][1]+=nReads
+        self.manifest[-1][2]+=nBases
+    
+    def close(self):
+        for chunkFile in self.files:
+            chunkFile.close()
+        self.files=[]
+    
+    def abort(self):
+        self.close()
+    
+    def finish(self):
+        '''
+        close the last chunk and write the manifest
+        '''
+        self.close()
+        path=os.path.join(self.setup.basedir, 'chunks.manifest.tsv')
+        with open(path, 'w') as manifest:
+            print('#chunk\treads\tbases', file=manifest)
+            for first, nReads, nBases in self.manifest:
+                print('{}\t{}\t{}'.format(first, nReads, nBases), \
+                      file=manifest)
+
+
+class StreamFiles(object):
+    '''
+    Drop-in replacement for ChunkFiles that feeds the reads through named
+    pipes into concurrently running mapping processes instead of writing
+    chunk files. The mapping command is a string.Template with the
+    placeholders ${pair1}, ${pair2} and ${chunk}. Spans of readsPerSpan
+    reads (pairs) are handed out to the processes in turn. If anything goes
+    wrong, abort() stops the mappers and feeders and removes the pipes
+    '''
+    
+    def __init__(self, setup, mates, template, nStreams, readsPerSpan=1<<14, \
+                 maxPending=8):
+        self.setup=setup
+        self.mates=mates
+        self.readsPerSpan=readsPerSpan
+        self.nReads=0
+        self.inSpan=0
+        self.current=-1
+        self.streams=[]
+        self.manifest=[]
+        self.fifos=[]
+        self.stop=threading.Event()
+        try:
+            for n in range(nStreams):
+                self.start('stream{}'.format(n), template, maxPending)
+        except BaseException:
+            self.abort()
+            raise
+    
+    def start(self, chunk, template, maxPending):
+        '''
+        create the pipes of a chunk and start its mapping process and feeders
+        '''
+        fifos=[os.path.join(self.setup.basedir, '{}.{}.fq'.format(chunk, mate))\
+               for mate in self.mates]
+        for fifo in fifos:
+            if os.path.exists(fifo):
+                os.remove(fifo)
+            os.mkfifo(fifo)
+            self.fifos.append(fifo)
+        cmd=template.substitute({'pair1': fifos[0], \
+                                 'pair2': fifos[1] if len(fifos)>1 else '',\
+                                 'chunk': chunk})
+        logging.debug('Starting {}'.format(cmd))
+        #in a session of its own, so the whole pipeline can be killed
+        process=subprocess.Popen(cmd, shell=True, executable='/bin/bash', \
+                                 start_new_session=True)
+        #each pipe is written by a thread of its own, so a mapper waiting
+        #for one mate never blocks the others
+        queues=[queue.Queue(maxPending) for _ in fifos]
+        threads=[]
+        self.streams.append((chunk, fifos, process, queues, threads))
+        self.manifest.append([chunk, 0, 0])
+        for fifo, q in zip(fifos, queues):
+            thread=threading.Thread(target=self.feed, args=(fifo, q, self.stop))
+            thread.start()
+            threads.append(thread)
+    
+    @staticmethod
+    def feed(fifo, q, stop):
+        '''
+        write everything put into the queue to the named pipe until None,
+        or until stop is set
+        '''
+        #opening a pipe blocks until there is a reader, so we poll instead
+        #to notice a mapper that never shows up
+        while True:
+            try:
+                fd=os.open(fifo, os.O_WRONLY|os.O_NONBLOCK)
+                break
+            except OSError as e:
+                if e.errno!=errno.ENXIO:
+                    raise
+                if stop.wait(0.1):
+                    return
+        os.set_blocking(fd, True)
+        try:
+            with open(fd, 'wb') as pipe:
+                while True:
+                    data=q.get()
+                    if data is None or stop.is_set():
+                        break
+                    pipe.write(data)
+        except BrokenPipeError:
+            #the mapper died, the writer notices and aborts
+            pass
+    
+    def check(self, chunk, process):
+        '''
+        bail out if a mapping process died while we're waiting for it
+        '''
+        if process.poll() is not None:
+            logging.critical('Mapping process of {} exited with {} before '\
+                             'reading all reads'.format(chunk, \
+                                                        process.returncode))
+            sys.exit(1)
+    
+    def put(self, chunk, process, q, data):
+        '''
+        queue data for a feeder, checking its mapper while the queue is full
+        '''
+        while True:
+            try:
+                q.put(data, timeout=1)
+                return
+            except queue.Full:
+                self.check(chunk, process)
+    
+    def room(self):
+        '''
+        return how many reads still go to the current process, moving on
+        to the next one if its span is full
+        '''
+        if self.current<0 or self.inSpan>=self.readsPerSpan:
+            self.current=(self.current+1)%len(self.streams)
+            self.inSpan=0
+        return self.readsPerSpan-self.inSpan
+    
+    def span(self, blocks, starts, maxSpan):
+        return min(maxSpan, self.room())
+    
+    def write(self, raws, nReads, nBases):
+        #the queued views keep their blocks alive until they are written
+        chunk, fifos, process, queues, threads=self.streams[self.current]
+        for q, raw in zip(queues, raws):
+            self.put(chunk, process, q, raw)
+        self.nReads+=nReads
+        self.inSpan+=nReads
+        self.manifest[self.current][1]+=nReads
+        self.manifest[self.current][2]+=nBases
+    
+    def finish(self):
+        '''
+        close all pipes, wait for the mapping processes and remove the pipes
+        '''
+        failed=False
+        try:
+            for chunk, fifos, process, queues, threads in self.streams:
+                for q in queues:
+                    self.put(chunk, process, q, None)
+            for chunk, fifos, process, queues, threads in self.streams:
+                for thread in threads:
+                    thread.join(1)
+                    while thread.is_alive():
+                        self.check(chunk, process)
+                        thread.join(1)
+                if process.wait()!=0:
+                    logging.critical('Mapping process of {} exited with {}'\
+                                     .format(chunk, process.returncode))
+                    failed=True
+        except BaseException:
+            self.abort()
+            raise
+        self.remove_fifos()
+        path=os.path.join(self.setup.basedir, 'chunks.manifest.tsv')
+        with open(path, 'w') as manifest:
+            print('#chunk\treads\tbases', file=manifest)
+            for chunk, nReads, nBases in self.manifest:
+                print('{}\t{}\t{}'.format(chunk, nReads, nBases), \
+                      file=manifest)
+        if failed:
+            sys.exit(1)
+    
+    def abort(self):
+        '''
+        kill the mapping processes that are still running, stop the feeders
+        and remove the pipes
+        '''
+        self.stop.set()
+        for chunk, fifos, process, queues, threads in self.streams:
+            if process.poll() is None:
+                logging.warning('Stopping the mapping process of {}'\
+                                .format(chunk))
+                try:
+                    os.killpg(process.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            process.wait()
+        #with the mappers gone, feeders waiting for data get None, those
+        #writing get a broken pipe and those opening a pipe see stop
+        for chunk, fifos, process, queues, threads in self.streams:
+            for q in queues:
+                try:
+                    q.put_nowait(None)
+                except queue.Full:
+                    pass
+            for thread in threads:
+                thread.join()
+        self.remove_fifos()
+    
+    def remove_fifos(self):
+        for fifo in self.fifos:
+            if os.path.exists(fifo):
+                os.remove(fifo)
+        self.fifos=[]
+
+
+def fingerprint(*sequences):
+    '''
+    The 128 bit keyed blake2b digest of the sequences of a read (pair).
+    Unlike hash(), it is the same in every process and run
+    '''
+    digest=blake2b(key=FINGERPRINT_KEY, digest_size=16)
+    for sequence in sequences:
+        digest.update(sequence)
+        digest.update(b'\n')
+    return digest.digest()
+
+
+class DuplicateFilter(object):
+    '''
+    Streaming filter for exact duplicate reads (or pairs), identified by a
+    fingerprint of their sequences. Distinct reads are only taken for
+    duplicates if their 128 bit fingerprints collide, the chance of which
+    is below n*n/2**129 for n reads, less than 1e-18 for 10^10 reads.
+    Fingerprints are kept in a set in memory. Once the set exceeds its
+    memory budget, it is split into partitions on disk and all following
+    records are spilled into the matching partition. After the stream has
+    ended, survivors() removes the remaining duplicates one partition at a
+    time
+    '''
+    
+    #rough memory footprint of a 16 byte fingerprint in a python set
+    BYTES_PER_ENTRY=96
+    
+    def __init__(self, spillDir, nMates, maxMemory, nPartitions=64):
+        self.spillDir=spillDir
+        self.nMates=nMates
+        self.maxEntries=maxMemory*(1<<20)//self.BYTES_PER_ENTRY
+        self.nPartitions=nPartitions
+        self.seen=set()
+        self.partitions=None
+        self.duplicates=0
+        self.recordHeader=struct.Struct('<16s{}I'.format(nMates))
+    
+    def check(self, fingerprint, raws):
+        '''
+        returns True if the record should be written now. Records that
+        can't be decided in memory are spilled and False is returned
+        '''
+        if self.partitions is None:
+            if fingerprint in self.seen:
+                self.duplicates+=1
+                return False
+            self.seen.add(fingerprint)
+            if len(self.seen)>self.maxEntries:
+                self.spill()
+            return True
+        partition=self.partitions[fingerprint[0]%self.nPartitions]
+        partition.write(self.recordHeader.pack(fingerprint, \
+                                               *map(len, raws)))
+        for raw in raws:
+            partition.write(raw)
+        return False
+    
+    def spill(self):
+        logging.info('Duplicate fingerprints exceed the memory budget, '\
+                     'spilling to {}'.format(self.spillDir))
+        if not os.path.exists(self.spillDir):
+            os.mkdir(self.spillDir)
+        fingerprints=[[] for _ in range(self.nPartitions)]
+        for fingerprint in self.seen:
+            fingerprints[fingerprint[0]%self.nPartitions].append(fingerprint)
+        self.seen=set()
+        for n, partition in enumerate(fingerprints):
+            with open(self.partition_path(n, 'fingerprints'), 'wb') as f:
+                f.write(b''.join(partition))
+        self.partitions=[open(self.partition_path(n, 'records'), 'wb', \
+                              buffering=1<<20) \
+                         for n in range(self.nPartitions)]
+    
+    def partition_path(self, n, kind):
+        return os.path.join(self.spillDir, '{}.{}'.format(n, kind))
+    
+    def survivors(self):
+        '''
+        yield the raw records of all spilled reads that are not duplicates
+        '''
+        if self.partitions is None:
+            return
+        for partition in self.partitions:
+            partition.close()
+        for n in range(self.nPartitions):
+            with open(self.partition_path(n, 'fingerprints'), 'rb') as f:
+                fingerprints=f.read()
+            seen={fingerprints[i:i+16] \
+                  for i in range(0, len(fingerprints), 16)}
+            with open(self.partition_path(n, 'records'), 'rb') as f:
+                while True:
+                    header=f.read(self.recordHeader.size)
+                    if not header:
+                        break
+                    fingerprint, *lengths=self.recordHeader.unpack(header)
+                    raws=[f.read(length) for length in lengths]
+                    if fingerprint in seen:
+                        self.duplicates+=1
+                        continue
+                    seen.add(fingerprint)
+                    yield raws
+            os.remove(self.partition_path(n, 'fingerprints'))
+            os.remove(self.partition_path(n, 'records'))
+        os.rmdir(self.spillDir)
+
+
+class CompressedChunkWriter(object):
+    '''
+    Writer for compressed chunk files. Reads are collected into large blocks
+    that are compressed by a pool of worker processes (or in place if there
+    is no pool) and written in order as gzip members or BGZF blocks
+    '''
+    
+    def __init__(self, path, compression, pool=None, maxPending=0, \
+                 blockSize=1<<22):
+        self.file=open(path, 'wb')
+        self.compression=compression
+        self.compress=bgzf_compress if compression=='bgzf' else gzip_compress
+        self.pool=pool
+        self.blockSize=blockSize
+        self.buffer=[]
+        self.bufferSize=0
+        self.pending=[]
+        #don't let compressed blocks pile up in memory
+        self.maxPending=maxPending
+        
+    def write(self, data):
+        self.buffer.append(data)
+        self.bufferSize+=len(data)
+        if self.bufferSize>=self.blockSize:
+            self.flush_block()
+    
+    def flush_block(self):
+        if not self.buffer:
+            return
+        block=b''.join(self.buffer)
+        self.buffer=[]
+        self.bufferSize=0
+        if self.pool is None:
+            self.file.write(self.compress(block))
+            return
+        self.pending.append(self.pool.apply_async(self.compress, (block,)))
+        while len(self.pending)>self.maxPending:
+            self.file.write(self.pending.pop(0).get())
+    
+    def close(self):
+        self.flush_block()
+        for result in self.pending:
+            self.file.write(result.get())
+        self.pending=[]
+        if self.compression=='bgzf':
+            self.file.write(BGZF_EOF)
+        self.file.close()
+
+
+def run_setup(setup):
+    '''
+    run the setup of a single library, the reference is checked beforehand
+    '''
+    setup.run(checkReference=False)
+
+def apportion_chunks(nChunks, weights):
+    '''
+    Split nChunks into shares proportional to the weights by largest
+    remainders, so the shares sum up to nChunks. Every share is at least 1,
+    taken from the largest share, unless there are fewer chunks than weights
+    '''
+    #without any weight, the chunks are split evenly
+    if not sum(weights):
+        weights=[1]*len(weights)
+    total=sum(weights)
+    quotas=[nChunks*weight/total for weight in weights]
+    shares=[int(quota) for quota in quotas]
+    byRemainder=sorted(range(len(weights)), \
+                       key=lambda i: quotas[i]-shares[i], reverse=True)
+    for i in byRemainder[:nChunks-sum(shares)]:
+        shares[i]+=1
+    for i in range(len(shares)):
+        if shares[i]==0:
+            largest=max(range(len(shares)), key=lambda j: shares[j])
+            if shares[largest]>1:
+                shares[largest]-=1
+            shares[i]=1
+    return shares
+
+def setup_libraries(reference, libraries, basedir, nChunks=None, \
+                    virtual=False, threads=1, compression=None, dedup=False, \
+                    dedupMemory=4096, balance='reads', stream=False):
+    '''
+    Check the reference and ingest all libraries concurrently. libraries is a
+    list of (id, pair1, pair2, nPairs) tuples, each library gets its own
+    folder and a share of the chunks proportional to its number of pairs.
+    When streaming, every library is streamed into all nChunks mappers.
+    Threads left over by the libraries are used to compress the chunks.
+    '''
+    nParallel=max(1, min(threads, len(libraries)))
+    setups=[]
+    for libId, pair1, pair2, nPairs in libraries:
+        libDir=os.path.join(basedir, libId)
+        if not os.path.exists(libDir):
+            os.mkdir(libDir)
+        setups.append(Setup(reference, pair1, pair2, libDir, nPairs, \
+                            nChunks, virtual, compression, \
+                            max(1, threads//nParallel), dedup, \
+                            dedupMemory//nParallel, balance, stream))
+    if nChunks and len(setups)>1 and not stream:
+        #the counts are cached, so the chunking doesn't count again
+        for setup in setups:
+            if dedup:
+                setup.nPairs=setup.count_survivors()[0]
+            elif setup.nPairs is None:
+                setup.nPairs=setup.count_reads(setup.readFile1)
+        shares=apportion_chunks(nChunks, [setup.nPairs for setup in setups])
+        for setup, share in zip(setups, shares):
+            setup.nChunks=share
+    
+    setups[0].check_fasta_header()
+    if nParallel>1:
+        #the library processes may need pools of their own for compression,
+        #which daemonic multiprocessing.Pool workers can't have
+        with ProcessPoolExecutor(nParallel) as executor:
+            list(executor.map(run_setup, setups))
+    else:
+        for setup in setups:
+            run_setup(setup)
                     
 if __name__ == '__main__':
     
@@ -92,14 +960,36 @@ if __name__ == '__main__':
     #parse arguments
     parser = argparse.ArgumentParser()
     parser.add_argument('reference', type=str)
-    parser.add_argument('pair1', type=str)
-    parser.add_argument('pair2', type=str)
     parser.add_argument('outDir', type=str)
-    parser.add_argument('nPairs', type=int)
+    parser.add_argument('-library', type=str, nargs=4, action='append', \
+                        required=True, metavar=('ID', 'PAIR1', 'PAIR2', 'NPAIRS'),\
+                        help='may be given several times, use None for '\
+                        'absent values')
     parser.add_argument('-nChunks', type=int, default=None)
+    parser.add_argument('-threads', type=int, default=1)
+    parser.add_argument('-compress', type=str, choices=['gzip', 'bgzf'], \
+                        default=None, help='compress the chunk files')
+    parser.add_argument('-dedup', action='store_true', \
+                        help='remove exact duplicate reads (pairs)')
+    parser.add_argument('-dedupMemory', type=int, default=4096, \
+                        help='memory budget for deduplication in MB')
+    parser.add_argument('-balance', type=str, choices=['reads', 'bases'], \
+                        default='reads', help='balance the chunks by number '\
+                        'of reads or bases')
+    parser.add_argument('-stream', action='store_true', \
+                        help='feed the reads through named pipes into nChunks '\
+                        'mapping processes, started from the map.template '\
+                        'file in each library folder')
+    parser.add_argument('-virtual', action='store_true',\
+                        help='index the read files instead of writing chunks')
     parser.add_argument('-v', '--verbosity', type=str, \
                         choices=['INFO','WARNING','ERROR', 'DEBUG'])
     args=parser.parse_args()
-    i=Setup(args.reference, args.pair1, args.pair2, \
-            args.outDir, args.nPairs, args.nChunks)
-    i.run()
+    #a killed setup exits normally, so streaming cleans up its mappers
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+    libraries=[(libId, pair1, None if pair2=='None' else pair2, \
+                None if nPairs=='None' else int(nPairs)) \
+               for libId, pair1, pair2, nPairs in args.library]
+    setup_libraries(args.reference, libraries, args.outDir, args.nChunks, \
+                    args.virtual, args.threads, args.compress, args.dedup, \
+                    args.dedupMemory, args.balance, args.stream)
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+'''
+Binary variant track of the variant integration. The integrated variants
+are kept as a structured array in <prefix>.npy, one record per variant with
+the scaffold code, its start and end in the integrated sequence, the
+perfect coverage of the replaced intervall and offsets into the byte heap
+<prefix>.alleles holding the variant and the replaced reference allel.
+<prefix>.index.tsv lists the runs of consecutive variants per scaffold, so
+readers seek straight to the variants of a scaffold.
+'''
+
+import argparse
+import sys
+import os
+import logging
+import shutil
+import numpy as np
+
+RECORD = np.dtype([('scaffold', '<i4'), ('start', '<i8'), ('end', '<i8'), \
+                   ('coverage', '<i4'), ('variant', '<i8'), \
+                   ('variantLength', '<i4'), ('ref', '<i8'), \
+                   ('refLength', '<i4')])
+
+
+class VarTrackWriter(object):
+    '''
+    Writes a binary variant track, with variants added one scaffold after
+    the other
+    '''
+
+    def __init__(self, prefix, bufferSize=1<<16):
+        self.prefix = prefix
+        self.bufferSize = bufferSize
+        self.raw = open(prefix+'.raw', 'wb')
+        self.heap = open(prefix+'.alleles', 'wb')
+        self.heapSize = 0
+        self.nRecords = 0
+        self.buffer = []
+        self.scaffolds = []
+        self.codes = {}
+        #scaffold, first record and number of records of each run
+        self.runs = []
+
+    def add(self, identifier, start, end, variant, ref, coverage):
+        code = self.codes.get(identifier)
+        if code is None:
+            code = self.codes[identifier] = len(self.scaffolds)
+            self.scaffolds.append(identifier)
+        if self.runs and self.runs[-1][0] == code:
+            self.runs[-1][2] += 1
+        else:
+            self.runs.append([code, self.nRecords, 1])
+        variant = variant.encode()
+        ref = ref.encode()
+        self.buffer.append((code, start, end, coverage, self.heapSize, \
+                            len(variant), self.heapSize+len(variant), len(ref)))
+        self.heap.write(variant+ref)
+        self.heapSize += len(variant)+len(ref)
+        self.nRecords += 1
+        if len(self.buffer) == self.bufferSize:
+            self.flush()
+
+    def extend(self, Track):
+        '''
+        append all variants of another VarTrack, e.g. a fragment written by
+        a worker process
+        '''
+        for identifier, start, end, variant, ref, coverage in Track:
+            self.add(identifier, start, end, variant, ref, coverage)
+
+    def flush(self):
+        self.raw.write(np.array(self.buffer, dtype=RECORD).tobytes())
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.raw.close()
+        self.heap.close()
+        #prepend the .npy header to the raw records
+        with open(self.prefix+'.npy', 'wb') as npy, \
+             open(self.raw.name, 'rb') as data:
+            np.lib.format.write_array_header_1_0(npy, \
+                {'descr': np.lib.format.dtype_to_descr(RECORD), \
+                 'fortran_order': False, 'shape': (self.nRecords,)})
+            shutil.copyfileobj(data, npy)
+        os.remove(self.raw.name)
+        #the index is written last and marks the track as complete
+        with open(self.prefix+'.index.tsv', 'w') as index:
+            for code, first, nRecords in self.runs:
+                print('{}\t{}\t{}'.format(self.scaffolds[code], first, \
+                                          nRecords), file=index)
+
+
+class VarTrack(object):
+    '''
+    Memory mapped reader of a binary variant track. Iterating it yields
+    (scaffold, start, end, variant, ref, coverage) tuples in file order
+    '''
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.records = np.load(prefix+'.npy', mmap_mode='r')
+        if os.path.getsize(prefix+'.alleles'):
+            self.heap = np.memmap(prefix+'.alleles', dtype=np.uint8, mode='r')
+        else:
+            self.heap = np.zeros(0, dtype=np.uint8)
+        self.scaffolds = []
+        #runs of (first record, number of records) per scaffold
+        self.index = {}
+        with open(prefix+'.index.tsv') as index:
+            for line in index:
+                identifier, first, nRecords = line.rstrip('\n').split('\t')
+                if identifier not in self.index:
+                    self.index[identifier] = []
+                    self.scaffolds.append(identifier)
+                self.index[identifier].append((int(first), int(nRecords)))
+        #scaffold names by code, in the order of the runs
+        self.names = {}
+        for identifier, runs in self.index.items():
+            for first, nRecords in runs:
+                self.names[int(self.records[first]['scaffold'])] = identifier
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, identifier):
+        return identifier in self.index
+
+    def __iter__(self):
+        for first in range(0, len(self.records), 1<<16):
+            yield from self.rows(self.records[first:first+(1<<16)])
+
+    def scaffold(self, identifier):
+        '''
+        the records of the variants on a scaffold, as a structured array
+        '''
+        runs = self.index.get(identifier, [])
+        if len(runs) == 1:
+            first, nRecords = runs[0]
+            return self.records[first:first+nRecords]
+        return np.concatenate([self.records[first:first+nRecords] \
+                               for first, nRecords in runs] or \
+                              [self.records[:0]])
+
+    def variants(self, identifier):
+        '''
+        yields the (scaffold, start, end, variant, ref, coverage) tuples of
+        the variants on a scaffold
+        '''
+        yield from self.rows(self.scaffold(identifier))
+
+    def rows(self, records):
+        heap = self.heap
+        for code, start, end, coverage, variant, variantLength, ref, \
+            refLength in records.tolist():
+            yield self.names[code], start, end, \
+                  heap[variant:variant+variantLength].tobytes().decode(), \
+                  heap[ref:ref+refLength].tobytes().decode(), coverage
+
+
+def read_var_track(path):
+    '''
+    yields the (scaffold, start, end, variant, ref, coverage) tuples of a
+    variant track, either binary (given by its prefix) or a varTrack.tsv
+    '''
+    if not path.endswith('.tsv'):
+        yield from VarTrack(path)
+        return
+    with open(path) as varTrack:
+        for entry in varTrack:
+            identifier, start, end, variant, ref, coverage = \
+                entry.rstrip('\n').split('\t')
+            yield identifier, int(start), int(end), variant, ref, int(coverage)
+
+def export_tsv(Track, out):
+    for row in Track:
+        out.write('{}\t{}\t{}\t{}\t{}\t{}\n'.format(*row))
+
+
+if __name__ == '__main__':
+
+    logFormat = "%(asctime)s [%(levelname)s] %(message)s"
+    logging.basicConfig(stream=sys.stderr, format=logFormat, level='INFO')
+
+    #parse arguments
+    parser = argparse.ArgumentParser()
+    subparsers=parser.add_subparsers(dest='command')
+    subparsers.required=True
+
+    export=subparsers.add_parser('export', help='write a binary variant '\
+                                 'track as varTrack.tsv')
+    export.add_argument('prefix', type=str)
+    export.add_argument('-scaffold', type=str, default=None, \
+                        help='only export the variants on this scaffold')
+    export.add_argument('-out', type=str, default=None, \
+                        help='output file, stdout if omitted')
+
+    convert=subparsers.add_parser('import', help='convert a varTrack.tsv '\
+                                  'into a binary variant track')
+    convert.add_argument('tsv', type=str)
+    convert.add_argument('prefix', type=str)
+    args=parser.parse_args()
+
+    if args.command=='export':
+        Track=VarTrack(args.prefix)
+        rows=Track if args.scaffold is None else Track.variants(args.scaffold)
+        if args.out is None:
+            export_tsv(rows, sys.stdout)
+        else:
+            with open(args.out, 'w') as out:
+                export_tsv(rows, out)
+    else:
+        Writer=VarTrackWriter(args.prefix)
+        for row in read_var_track(args.tsv):
+            Writer.add(*row)
+        Writer.close()
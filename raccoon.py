@@ -54,33 +54,21 @@ class Protocol(object):
         else:
             self.inBaseDir=''
 
-        Pair1=InBaseDir.find('p1')
-        Pair2=InBaseDir.find('p2')
-        NPairs=InBaseDir.find('nPairs')
+        #all read groups are assigned to the same sample
+        self.sample=InBaseDir.attrib.get('sample', 'sample')
         deduplicate=InBaseDir.find('deduplicate')
         
-        if Pair1 is None:
-            logging.critical('Read file not correctly provided in protocol at {}'.format(self.protocol))
-            sys.exit(1)
-        self.pair1=os.path.join(self.inBaseDir,Pair1.text)
-        if Pair2 is None:
-            self.pair2=None
-        else:
-            self.pair2=os.path.join(self.inBaseDir,Pair2.text)
-        if NPairs is None:
-            logging.critical('Must provide number of read pairs in protocol at {}\n'\
-                             '\tEg: run cat yourReadFile.fq | grep \'^@\' | wc -l'.format(self.protocol))
-            sys.exit(1)
-            
-        #self.pair1=os.path.join(self.inBaseDir,Pair1.text)
-        self.nPairs=int(NPairs.text)
-        absentPair=None
-        if not os.path.exists(self.pair1):
-            absentPair=self.pair1
-        elif self.pair2 is not None and not os.path.exists(self.pair2):
-            absentPair=self.pair2
-        if absentPair:
-            logging.critical('The provided readfile at {} does not exist'.format(absentPair))
+        #a single library may be given directly within the input tag
+        Libraries=InBaseDir.findall('library')
+        if not Libraries:
+            Libraries=[InBaseDir]
+        self.libraries=[]
+        for n, LibraryTag in enumerate(Libraries, 1):
+            self.libraries.append(self.parseLibrary(LibraryTag, n))
+        libIds=[library.identifier for library in self.libraries]
+        if len(set(libIds))!=len(libIds):
+            logging.critical('The library ids in protocol at {} are not '\
+                             'unique'.format(self.protocol))
             sys.exit(1)
         
         if deduplicate is not None:
@@ -96,6 +84,64 @@ class Protocol(object):
         else:
             self.deduplicate=False
             
+        #fetch reference scaffolds on demand when integrating variants?
+        lazyReference=p.find('lazyReference')
+        self.lazyReference=lazyReference is not None and \
+                           lazyReference.text=='true'
+        #look up perfect coverage in persisted tracks of the alignments?
+        coverageTrack=p.find('coverageTrack')
+        self.coverageTrack=coverageTrack is not None and \
+                           coverageTrack.text=='true'
+        #only call variants around the regions changed in the previous
+        #iteration?
+        skipUnchanged=p.find('skipUnchanged')
+        self.skipUnchanged=skipUnchanged is not None and \
+                           skipUnchanged.text=='true'
+        self.flank=500
+        if self.skipUnchanged:
+            self.flank=int(skipUnchanged.get('flank', '500'))
+        #lift the alignments over to the integrated reference in the remap
+        #stage, mapping only the reads touching edits again?
+        liftover=p.find('liftover')
+        self.liftover=liftover is not None and liftover.text=='true'
+        self.liftoverMargin=5
+        if self.liftover:
+            self.liftoverMargin=int(liftover.get('margin', '5'))
+        #stream the reads straight into the mappers in the map stage?
+        streaming=p.find('streaming')
+        self.streaming=streaming is not None and streaming.text=='true'
+        self.nStreams=1
+        if self.streaming:
+            self.nStreams=int(streaming.get('streams', '1'))
+        #stream chunks from byte ranges of the input instead of copying them?
+        virtualChunks=p.find('virtualChunks')
+        self.virtualChunks=virtualChunks is not None and \
+                           virtualChunks.text=='true'
+        #compress chunk files with gzip or bgzf?
+        compressChunks=p.find('compressChunks')
+        self.compressChunks=None
+        if compressChunks is not None:
+            if compressChunks.text not in ('gzip', 'bgzf'):
+                logging.critical("The compressChunks tag may only have the "\
+                                 "values 'gzip' or 'bgzf'. The provided value "\
+                                 "is '{}'".format(compressChunks.text))
+                sys.exit(1)
+            self.compressChunks=compressChunks.text
+        #balance the read chunks by number of reads or bases?
+        balanceChunks=p.find('balanceChunks')
+        self.balanceChunks='reads'
+        if balanceChunks is not None:
+            if balanceChunks.text not in ('reads', 'bases'):
+                logging.critical("The balanceChunks tag may only have the "\
+                                 "values 'reads' or 'bases'. The provided "\
+                                 "value is '{}'".format(balanceChunks.text))
+                sys.exit(1)
+            self.balanceChunks=balanceChunks.text
+        #drop exact duplicate read pairs while chunking?
+        dedupReads=p.find('dedupReads')
+        self.dedupReads=dedupReads is not None and dedupReads.text=='true'
+        dedupMemory=p.find('dedupMemory')
+        self.dedupMemory=None if dedupMemory is None else int(dedupMemory.text)
                 
         ploidy=p.find('ploidy')
         if ploidy is None:
@@ -154,7 +200,7 @@ class Protocol(object):
         self.samtools='samtools'
         self.picardtools='picard.jar'
         self.gatk='gatk'
-        self.pyhton3='python3'
+        self.python3='python3'
         self.tmpdir='$TMPDIR'
         self.java='java'
         #reset defaults if paths were defined
@@ -178,6 +224,67 @@ class Protocol(object):
         #do it each time we construct the command
         self.java+=' -Djava.io.tmpdir={}'.format(self.tmpdir)
 
+    def parseLibrary(self, LibraryTag, n):
+        '''
+        parse the read files of a library tag (or the input tag) and check
+        that they exist
+        '''
+        baseDir=LibraryTag.attrib.get('baseDir', self.inBaseDir)
+        identifier=LibraryTag.attrib.get('id', 'lib{}'.format(n))
+        if not re.match('^[a-zA-Z0-9_.\-]+$', identifier):
+            logging.critical('Library id {} may only contain the characters '\
+                             'a-z, A-Z, 0-9, _.-'.format(identifier))
+            sys.exit(1)
+        Pair1=LibraryTag.find('p1')
+        Pair2=LibraryTag.find('p2')
+        NPairs=LibraryTag.find('nPairs')
+        
+        if Pair1 is None:
+            logging.critical('Read file not correctly provided in protocol at {}'.format(self.protocol))
+            sys.exit(1)
+        pair1=os.path.join(baseDir,Pair1.text)
+        if Pair2 is None:
+            pair2=None
+        else:
+            pair2=os.path.join(baseDir,Pair2.text)
+        #without nPairs, the setup stage counts the reads itself
+        if NPairs is None:
+            nPairs=None
+        else:
+            nPairs=int(NPairs.text)
+        absentPair=None
+        if not os.path.exists(pair1):
+            absentPair=pair1
+        elif pair2 is not None and not os.path.exists(pair2):
+            absentPair=pair2
+        if absentPair:
+            logging.critical('The provided readfile at {} does not exist'.format(absentPair))
+            sys.exit(1)
+        
+        return Library(identifier, LibraryTag.attrib.get('name', identifier),\
+                       pair1, pair2, nPairs)
+
+
+class Library(object):
+    '''
+    A sequencing library or lane with its read files. Each library is mapped
+    as a read group of its own
+    '''
+    
+    def __init__(self, identifier, name, pair1, pair2, nPairs):
+        self.identifier=identifier
+        self.name=name
+        self.pair1=pair1
+        self.pair2=pair2
+        self.nPairs=nPairs
+        
+    def readGroup(self, sample):
+        '''
+        return the @RG line of this library, with escaped tabs for bwa -R
+        '''
+        return '@RG\\tID:{}\\tSM:{}\\tLB:{}'.format(self.identifier, sample,\
+                                                  self.name)
+
 
 class StageDriver(object):
     
@@ -311,22 +418,53 @@ class StageDriver(object):
                                      'ECsetup.py')
         logging.info('Calling setup script located at {}'.format(setupScript))
 
-        cmd=string.Template('${ECSetupPath} ${reference} '\
-                            '${pair1} ${pair2} ${outDir} ${nPairs}').\
+        cmd=string.Template('${ECSetupPath} ${reference} ${outDir} '\
+                            '-threads ${threads}').\
         substitute({'ECSetupPath':  setupScript,\
                     'reference':    self.MyProtocol.reference,\
-                    'pair1':        self.MyProtocol.pair1,\
-                    'pair2':        self.MyProtocol.pair2,\
                     'outDir':       readDir,\
-                    'nPairs':       self.MyProtocol.nPairs})
-        if self.MyProtocol.nJobs is not None:
-            cmd+=' -nChunks {}'.format(self.MyProtocol.nJobs)
+                    'threads':      self.MyProtocol.nThreads})
+        cmd+=self.library_options()
+        #when streaming, the reads are chunked by the map stage
+        if not self.MyProtocol.streaming:
+            if self.MyProtocol.nJobs is not None:
+                cmd+=' -nChunks {}'.format(self.MyProtocol.nJobs)
+            if self.MyProtocol.virtualChunks:
+                cmd+=' -virtual'
+            if self.MyProtocol.compressChunks:
+                cmd+=' -compress {}'.format(self.MyProtocol.compressChunks)
+            if self.MyProtocol.balanceChunks!='reads':
+                cmd+=' -balance {}'.format(self.MyProtocol.balanceChunks)
+            cmd+=self.dedup_options()
         cmd+=';\n'
         logging.debug("Running command: {}".format(cmd))
         retCmd.append(Command(cmd, 'setup', os.path.join(readDir,"setup.out"), \
                         os.path.join(readDir,"setup.err")))
         return retCmd, readDir
     
+    def library_options(self):
+        '''
+        the -library options of the setup script for all libraries
+        '''
+        options=''
+        for library in self.MyProtocol.libraries:
+            options+=' -library {} {} {} {}'.format(library.identifier, \
+                                                    library.pair1, \
+                                                    library.pair2, \
+                                                    library.nPairs)
+        return options
+    
+    def dedup_options(self):
+        '''
+        the read deduplication options of the setup script
+        '''
+        if not self.MyProtocol.dedupReads:
+            return ''
+        options=' -dedup'
+        if self.MyProtocol.dedupMemory is not None:
+            options+=' -dedupMemory {}'.format(self.MyProtocol.dedupMemory)
+        return options
+    
     def index(self, iteration, reindex=False, piped=False):
         '''
         create job to index a reference
@@ -344,27 +482,29 @@ class StageDriver(object):
             if iteration==1:
                 # if not os.path.exists(self.baseDir):
                 #     os.mkdir(self.baseDir)
-                os.symlink(self.MyProtocol.reference, reference)
+                source=self.MyProtocol.reference
                 #build command
             elif iteration!=1:
-                lastPass=os.path.join(*[self.MyProtocol.outDir, \
-                                        'ITERATION_{}'.format(iteration-1),\
-                                        'correction',\
-                                         'reference.sanitizedVariants.fa'])
-                os.symlink(lastPass, reference)
+                source=os.path.join(*[self.MyProtocol.outDir, \
+                                      'ITERATION_{}'.format(iteration-1),\
+                                      'correction',\
+                                      'reference.sanitizedVariants.fa'])
+            os.symlink(source, reference)
         else:
             # reference=os.path.join(self.baseDir, 'reference.varcall.integrated.fa')
-            reference=os.path.join(self.previousStageDir, 'reference.varcall.integrated.fa')
-            varRef=os.path.join(self.stageDir, 'reference.varcall.integrated.fa')
-            os.symlink(reference, varRef)
-            reference=varRef
+            source=os.path.join(self.previousStageDir, 'reference.varcall.integrated.fa')
+            reference=os.path.join(self.stageDir, 'reference.varcall.integrated.fa')
+            os.symlink(source, reference)
             
         if reference.endswith('fasta'):
             seqdict=reference.replace(".fasta", ".dict")
         elif reference.endswith('.fa'):
             seqdict=reference.replace(".fa", ".dict")
         
-        if reindex:
+        #the integration and correction stages write the .fai and .dict
+        #along with the reference, no need to compute them again
+        linked=self.link_sidecars(source, reference, seqdict)
+        if reindex or linked:
             cmd=string.Template('${bwa} index ${reference};\n')\
             .substitute({'bwa':         self.MyProtocol.bwa,
                          'reference':   reference})
@@ -393,6 +533,25 @@ class StageDriver(object):
         return retCmd, self.stageDir
             
         
+    def link_sidecars(self, source, reference, seqdict):
+        '''
+        symlink the .fai and .dict of the source fasta to the ones of the
+        reference if both exist and are not older than the fasta. Returns
+        whether they have been linked
+        '''
+        sidecars=[(source+'.fai', reference+'.fai'), \
+                  (sequence_dict_path(source), seqdict)]
+        fastaTime=os.path.getmtime(source)
+        for sidecar, link in sidecars:
+            if not os.path.exists(sidecar) or \
+               os.path.getmtime(sidecar)<fastaTime:
+                return False
+        logging.info('Using the index and sequence dictionary of {}'\
+                     .format(source))
+        for sidecar, link in sidecars:
+            os.symlink(os.path.abspath(sidecar), link)
+        return True
+    
     def mapping(self, iteration, remap=False):
         '''create mapping jobs for all pairs in reads folder'''
         retCmd=list()
@@ -408,30 +567,34 @@ class StageDriver(object):
         # if not os.path.exists(self.baseDir):
         #     os.mkdir(self.baseDir) 
         #build commands
-        cmdTemplate=string.Template("${bwa} mem -M -t ${threads} -R"\
-                                    "'@RG\\tID:dummy\\tSM:dummy\\tLB:dummy' "\
+        cmdTemplate=string.Template("${readStream}${bwa} mem -M ${bwaOptions}"\
+                                    "-t ${threads} -R'${readGroup}' "\
                                     "${reference} ${pair1} ${pair2} |"\
                                     "${samtools} view -@ ${threads} -Shb - |"\
                                     "${samtools} sort -@ ${threads} -O bam "\
                                     "-T ${tmpBam} -o ${outfile} -;\n")
         
+        if remap and self.MyProtocol.liftover:
+            return self.liftover_mapping(reference), self.stageDir
+        if self.MyProtocol.streaming:
+            return self.streaming_mapping(cmdTemplate, reference, \
+                                          outfileSuffix), self.stageDir
+        
         readDir=os.path.join(os.path.join(self.MyProtocol.outDir, 'setup'))
-        pairNames=set()
         if not os.path.exists(readDir):
             logging.critical("Read directory does not exist. Did you run the setup stage?")
             sys.exit(1)
-        pairs=glob.glob(os.path.join(readDir, '*.fq'))
-        if not pairs:
-            logging.critical("There are no read pairs in {}".format(readDir))
-            sys.exit(1)
-        #get basenames of pairs and remove .p[12].fq
-        pairs=set(os.path.basename(re.sub('.p[12].fq', '', pair)) for pair in pairs)
-        for pairPrefix in pairs:
-            #check if we're dealing with single end reads
-            if self.MyProtocol.pair2==None:
-                pair2=''
+        chunks=[]
+        for library in self.MyProtocol.libraries:
+            libDir=os.path.join(readDir, library.identifier)
+            chunkTable=os.path.join(libDir, 'chunks.tsv')
+            if os.path.exists(chunkTable):
+                libChunks=self.virtual_chunks(chunkTable)
             else:
-                pair2=os.path.join(readDir,pairPrefix+'.p2.fq')
+                libChunks=self.chunk_files(libDir, library)
+            chunks+=[(library, library.identifier+'.'+chunk[0])+chunk[1:] \
+                     for chunk in libChunks]
+        for library, pairPrefix, readStream, bwaOptions, pair1, pair2 in chunks:
             randString=''.join(random.choice(string.ascii_uppercase + string.digits)\
                                for _ in range(6))
 
@@ -439,9 +602,11 @@ class StageDriver(object):
                                         'samtools': self.MyProtocol.samtools,\
                                         'threads':  self.MyProtocol.nThreads,\
                                         'reference':reference,\
-                                        'pair1':    os.path.join(readDir,\
-                                                                 pairPrefix\
-                                                                 +'.p1.fq'),
+                                        'readStream':readStream,\
+                                        'readGroup':library.readGroup(\
+                                                    self.MyProtocol.sample),\
+                                        'bwaOptions':bwaOptions,\
+                                        'pair1':    pair1,\
                                         'pair2':    pair2,\
                                         'tmpBam':   os.path.join(self.stageDir,
                                                                   randString),
@@ -458,6 +623,100 @@ class StageDriver(object):
         
         return retCmd, self.stageDir
     
+    def streaming_mapping(self, cmdTemplate, reference, outfileSuffix):
+        '''
+        create a single job that chunks the reads of all libraries and feeds
+        them through named pipes into concurrently running mapping processes.
+        The mapping command of every library is written to map.template in
+        its folder, with the pipes and chunk names left to the setup script
+        '''
+        j='remap' if outfileSuffix=='_remap.bam' else 'map'
+        for library in self.MyProtocol.libraries:
+            libDir=os.path.join(self.stageDir, library.identifier)
+            if not os.path.exists(libDir):
+                os.mkdir(libDir)
+            randString=''.join(random.choice(string.ascii_uppercase + string.digits)\
+                               for _ in range(6))
+            #single end libraries map a single pipe
+            pair2='' if library.pair2 is None else '${pair2}'
+            tmpBam=os.path.join(self.stageDir, randString+'.${chunk}')
+            outfile=os.path.join(self.stageDir, \
+                                 library.identifier+'.${chunk}'+outfileSuffix)
+            template=cmdTemplate.safe_substitute({\
+                    'bwa':      self.MyProtocol.bwa,\
+                    'samtools': self.MyProtocol.samtools,\
+                    'threads':  self.MyProtocol.nThreads,\
+                    'reference':reference,\
+                    'readStream':'',\
+                    'readGroup':library.readGroup(self.MyProtocol.sample),\
+                    'bwaOptions':'',\
+                    'pair2':    pair2,\
+                    'tmpBam':   tmpBam,\
+                    'outfile':  outfile})
+            #any failing part of the pipeline fails the mapper, which takes
+            #its partial output with it
+            template='set -o pipefail; {} || {{ rm -f {} {}.*; exit 1; }}\n'\
+                     .format(template.rstrip(';\n'), outfile, tmpBam)
+            with open(os.path.join(libDir, 'map.template'), 'w') as t:
+                t.write(template)
+        
+        setupScript=os.path.join(self.MyProtocol.scriptBase, 'ECsetup.py')
+        #libraries are streamed one after the other, each into nStreams
+        #mappers running with the configured number of threads
+        cmd='{} {} {} -threads 1 -nChunks {} -stream'\
+            .format(setupScript, reference, self.stageDir, \
+                    self.MyProtocol.nStreams)
+        cmd+=self.library_options()+self.dedup_options()+';\n'
+        logging.debug('Executing {}'.format(cmd))
+        return [Command(cmd, j, os.path.join(self.stageDir, j+'.out'), \
+                        os.path.join(self.stageDir, j+'.err'))]
+    
+    def liftover_mapping(self, reference):
+        '''
+        create a single job that lifts the merged alignments of the map stage
+        over to the integrated reference and maps the reads touching edited
+        sequence again. The remerge stage merges both bam files
+        '''
+        liftoverScript=os.path.join(self.MyProtocol.scriptBase, 'ECliftover.py')
+        outPrefix=os.path.join(self.stageDir, 'liftover')
+        randString=''.join(random.choice(string.ascii_uppercase + string.digits)\
+                           for _ in range(6))
+        #the read groups are passed on as fastq comments, their @RG lines
+        #as extra header lines
+        cmdTemplate=string.Template('${python3} ${liftoverScript} ${pieceMap} '\
+                                    '${inputBam} ${reference} ${outPrefix} '\
+                                    '-margin ${margin} -threads ${threads};\n'\
+                                    'mv ${outPrefix}.lifted.bam ${lifted};\n'\
+                                    '${bwa} mem -M -p -C -t ${threads} '\
+                                    '-H ${outPrefix}.rg.sam ${reference} '\
+                                    '${outPrefix}.realign.fq |'\
+                                    '${samtools} view -@ ${threads} -Shb - |'\
+                                    '${samtools} sort -@ ${threads} -O bam '\
+                                    '-T ${tmpBam} -o ${realigned} -;\n')
+        cmd=cmdTemplate.substitute({'python3':  self.MyProtocol.python3,\
+                                    'liftoverScript':liftoverScript,\
+                                    'pieceMap': os.path.join(self.baseDir, \
+                                                             'varintegration',\
+                                                             'pieceMap.tsv'),\
+                                    'inputBam': os.path.join(self.baseDir, \
+                                                             'merge', \
+                                                             'merged.map.bam'),\
+                                    'reference':reference,\
+                                    'outPrefix':outPrefix,\
+                                    'margin':   self.MyProtocol.liftoverMargin,\
+                                    'threads':  self.MyProtocol.nThreads,\
+                                    'lifted':   os.path.join(self.stageDir, \
+                                                             'lifted_remap.bam'),\
+                                    'bwa':      self.MyProtocol.bwa,\
+                                    'samtools': self.MyProtocol.samtools,\
+                                    'tmpBam':   os.path.join(self.stageDir, \
+                                                             randString),\
+                                    'realigned':os.path.join(self.stageDir, \
+                                                             'realigned_remap.bam')})
+        logging.debug('Executing {}'.format(cmd))
+        return [Command(cmd, 'remap', os.path.join(self.stageDir, 'remap.out'), \
+                        os.path.join(self.stageDir, 'remap.err'))]
+    
     def merge_bam(self, iteration, remerge=False, piped=False):
         '''
         construct command to merge bamfiles
@@ -530,7 +789,6 @@ class StageDriver(object):
                                     'pair2':    pair2,\
                                     'ECSetupPath':setupScript,\
                                     'outDir':   outDir,\
-                                    'nPairs':   self.MyProtocol.nPairs,\
                                     'reference':self.MyProtocol.reference})
         
         if piped:
@@ -600,6 +858,20 @@ class StageDriver(object):
                 pack=line.rstrip().split()
                 name, length=pack[0:2]
                 lengthIndex.append([name, int(length)])
+        #after the first iteration, only the regions changed by the last
+        #correction may be called, everything else is carried forward
+        regions=None
+        if self.MyProtocol.skipUnchanged and iteration>1:
+            regions=self.changed_regions(iteration, lengthIndex)
+        if regions is not None:
+            if not regions:
+                logging.info('No changes in iteration {}, there are no '\
+                             'variants to call'.format(iteration-1))
+                return retCmd, self.stageDir
+            #balance the chunks by the length of the regions to call
+            lengthIndex=[[name, sum(end-start for start, end in \
+                                    regions[name])] \
+                         for name, length in lengthIndex if name in regions]
         #chunks is a lol of name-length tuples, each list is roughly
         #equal in terms of sequence content
         chunks=partition_to_re_chunks(lengthIndex, nChunks)
@@ -610,9 +882,19 @@ class StageDriver(object):
                                     '-o ${varcalls};\n')
         
         for chunk in chunks:
+            #an empty interval list would call the whole genome
+            if not chunk:
+                continue
             intervalFile=os.path.join(self.previousStageDir, 'intervals.{}.list'.format(n))
             with open(intervalFile,'w') as intervals:
-                print("\n".join(x[0] for x in chunk), file=intervals)
+                if regions is None:
+                    print("\n".join(x[0] for x in chunk), file=intervals)
+                else:
+                    #gatk intervals are 1-based and closed
+                    print("\n".join('{}:{}-{}'.format(x[0], start+1, end) \
+                                     for x in chunk \
+                                     for start, end in regions[x[0]]), \
+                          file=intervals)
                 
             varcalls=os.path.join(self.stageDir, 'varcalls.raw.{}.vcf'.format(n))
             cmd=cmdTemplate.substitute({'java':         self.MyProtocol.java,\
@@ -635,6 +917,38 @@ class StageDriver(object):
         
         return retCmd, self.stageDir
     
+    def changed_regions(self, iteration, lengthIndex):
+        '''
+        read the regions changed by the correction of the previous iteration
+        and return them per scaffold, widened by the flank and merged.
+        Returns None if the previous iteration didn't record them
+        '''
+        changedRegions=os.path.join(*[self.MyProtocol.outDir, \
+                                      'ITERATION_{}'.format(iteration-1),\
+                                      'correction',\
+                                      'changedRegions.tsv'])
+        if not os.path.exists(changedRegions):
+            logging.warning('No changed regions at {}, calling variants on '\
+                            'the whole reference'.format(changedRegions))
+            return None
+        lengths=dict(lengthIndex)
+        flank=self.MyProtocol.flank
+        regions={}
+        with open(changedRegions) as f:
+            for line in f:
+                if line.startswith('#'):
+                    continue
+                name, start, end=line.rstrip('\n').split('\t')
+                start=max(0, int(start)-flank)
+                end=min(lengths[name], int(end)+flank)
+                scaffoldRegions=regions.setdefault(name, [])
+                #the regions of a scaffold come sorted by start
+                if scaffoldRegions and start<=scaffoldRegions[-1][1]:
+                    scaffoldRegions[-1][1]=max(scaffoldRegions[-1][1], end)
+                else:
+                    scaffoldRegions.append([start, end])
+        return regions
+    
     def varintegration(self, iteration, piped=False):
         """
         Construction of call to ECintegrateVars
@@ -643,10 +957,18 @@ class StageDriver(object):
         
         integrateScript=os.path.join(self.MyProtocol.scriptBase, \
                                      'ECintegrateVars.py')
-        vcfs=",".join(glob.glob(os.path.join(self.previousStageDir, '*.vcf')))
+        vcfs=",".join(sorted(path for pattern in ('*.vcf', '*.vcf.gz', '*.bcf') \
+                             for path in glob.glob(os.path.join(\
+                                 self.previousStageDir, pattern))))
+        #without any varcalls the reference is passed on unchanged
+        if not vcfs:
+            vcfs="''"
+        #the script splits the threads among its worker processes
         cmdTemplate=string.Template('${python3} ${integrateScript} ${reference}'\
                                     ' ${vcfs} ${alignments} ${outFolder} '\
-                                    '${minSNVQ} ${minIndelQ};\n')
+                                    '${minSNVQ} ${minIndelQ} -threads '\
+                                    '${threads} -processes ${threads}${lazy}'\
+                                    '${coverageTrack};\n')
         reference=os.path.join(self.indexDir,'reference.fa')
         bam=os.path.join(*[self.baseDir,'prepvarcall',\
                            'merged.map.indelrealigned.bam'])
@@ -658,7 +980,12 @@ class StageDriver(object):
                                     'alignments':       bam,\
                                     'outFolder':        self.stageDir,\
                                     'minSNVQ':          self.MyProtocol.minSNVQ,\
-                                    'minIndelQ':        self.MyProtocol.minIndelQ})
+                                    'minIndelQ':        self.MyProtocol.minIndelQ,\
+                                    'threads':          self.MyProtocol.nThreads,\
+                                    'lazy':             ' -lazy' if \
+                                    self.MyProtocol.lazyReference else '',\
+                                    'coverageTrack':    ' -coverageTrack' if \
+                                    self.MyProtocol.coverageTrack else ''})
         
         if piped:
             return cmd, None
@@ -691,19 +1018,28 @@ class StageDriver(object):
         else:
             bam=os.path.join(self.previousStageDir, 'merged.remap.bam')
 
+        #prefix of the binary variant track
         varTrack=os.path.join(self.baseDir, \
                               'varintegration',\
-                              'varTrack.tsv')
+                              'varTrack')
 
+        #the script splits the threads among its worker processes
         cmdTemplate=string.Template('${python3} ${sanitizeScript} ${integratedVars}'\
-                                    ' ${alignments} ${varTrack} ${outFolder};\n')
+                                    ' ${alignments} ${varTrack} ${outFolder}'\
+                                    ' -threads ${threads} -processes '\
+                                    '${threads}${lazy}${coverageTrack};\n')
         
         cmd=cmdTemplate.substitute({'python3':      self.MyProtocol.python3,\
                                     'sanitizeScript':   sanitizeScript,\
                                     'integratedVars':   integratedVars,\
                                     'alignments':       bam,\
                                     'varTrack':         varTrack,\
-                                    'outFolder':        self.stageDir})
+                                    'outFolder':        self.stageDir,\
+                                    'threads':          self.MyProtocol.nThreads,\
+                                    'lazy':             ' -lazy' if \
+                                    self.MyProtocol.lazyReference else '',\
+                                    'coverageTrack':    ' -coverageTrack' if \
+                                    self.MyProtocol.coverageTrack else ''})
         if piped:
             return cmd, None
         
@@ -731,6 +1067,61 @@ class StageDriver(object):
         
         return cmd
     
+    def chunk_files(self, readDir, library):
+        '''
+        get the read chunks written by the setup stage as tuples of
+        prefix, read stream, bwa options and both pairs
+        '''
+        pairs=glob.glob(os.path.join(readDir, '*.fq'))+\
+              glob.glob(os.path.join(readDir, '*.fq.gz'))
+        if not pairs:
+            logging.critical("There are no read pairs in {}".format(readDir))
+            sys.exit(1)
+        #bwa reads gzipped chunks natively
+        suffix='.fq.gz' if pairs[0].endswith('.gz') else '.fq'
+        #get basenames of pairs and remove .p[12].fq(.gz)
+        pairs=set(os.path.basename(re.sub('\.p[12]\.fq(\.gz)?$', '', pair)) \
+                  for pair in pairs)
+        chunks=[]
+        for pairPrefix in pairs:
+            #check if we're dealing with single end reads
+            if library.pair2==None:
+                pair2=''
+            else:
+                pair2=os.path.join(readDir,pairPrefix+'.p2'+suffix)
+            chunks.append((pairPrefix, '', '', \
+                           os.path.join(readDir, pairPrefix+'.p1'+suffix), pair2))
+        #submit the chunks with the most bases first
+        manifest=os.path.join(readDir, 'chunks.manifest.tsv')
+        if os.path.exists(manifest):
+            bases={}
+            with open(manifest) as m:
+                for line in m:
+                    if not line.startswith('#'):
+                        entry=line.rstrip('\n').split('\t')
+                        bases[entry[0]]=int(entry[2])
+            chunks.sort(key=lambda chunk: bases.get(chunk[0], 0), reverse=True)
+        return chunks
+    
+    def virtual_chunks(self, chunkTable):
+        '''
+        get the byte ranges indexed by the setup stage as tuples of
+        prefix, read stream, bwa options and both pairs. The reads are
+        streamed from the original files into bwa's stdin
+        '''
+        rangeReader=os.path.join(self.MyProtocol.scriptBase, 'ECreadRange.py')
+        chunks=[]
+        with open(chunkTable) as table:
+            for line in table:
+                entry=line.rstrip('\n').split('\t')
+                readStream='{} {} {} | '.format(self.MyProtocol.python3, \
+                                                rangeReader, \
+                                                ' '.join(entry[1:]))
+                #more than one range means interleaved pairs
+                bwaOptions='-p ' if len(entry)>5 else ''
+                chunks.append((entry[0], readStream, bwaOptions, '-', ''))
+        return chunks
+    
     def constructCommand(self, jobname, cmdString):
         '''
         litte helper function to construct instances of "Command"